@@ -0,0 +1,32 @@
+"""
+Per request cost of turning the jwt cookie into a user id.
+
+    python -m benchmarks.bench_auth
+"""
+import os
+import timeit
+from uuid import uuid4
+
+os.environ.setdefault('SECRET_KEY', 'benchmark')
+
+from opti.auth.jwt import create_token, decode_token
+from opti.auth.service import user_id_from_token, token_cache
+
+
+NUMBER = 20_000
+
+
+def main():
+    token = create_token(str(uuid4()))
+
+    before = timeit.timeit(lambda: decode_token(token), number=NUMBER)
+    user_id_from_token(token)
+    after = timeit.timeit(lambda: user_id_from_token(token), number=NUMBER)
+
+    print(f"jose decode:  {before / NUMBER * 1e6:8.2f} us/request")
+    print(f"token cache:  {after / NUMBER * 1e6:8.2f} us/request")
+    print(f"hits: {token_cache.hits.value}, misses: {token_cache.misses.value}")
+
+
+if __name__ == '__main__':
+    main()
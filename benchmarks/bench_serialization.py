@@ -0,0 +1,53 @@
+"""
+Outbound websocket frame encoding: the old double encoding (model_dump_json + send_json)
+against one model_dump_json reused for publish and send_text.
+
+    python -m benchmarks.bench_serialization
+"""
+import json
+import timeit
+from uuid import uuid4
+
+from opti.chat.schema import ClientReceiveMessagesSchema, MessageInChat, GetPreviewReturn, ChatPreview, UserInfo, \
+    ClientReadMessagesSchema
+from opti.chat.serialization import dump
+from opti.core.utils import utc_now
+
+
+NUMBER = 2_000
+
+
+def message() -> MessageInChat:
+    return MessageInChat(
+        id=uuid4(), sender_id=uuid4(), recipient_id=uuid4(), text="hello " * 10, time=utc_now(), is_viewed=False,
+    )
+
+
+def send_json(data) -> str:
+    # what starlette WebSocket.send_json does with its argument
+    return json.dumps(data, separators=(",", ":"), ensure_ascii=False)
+
+
+SCHEMAS = {
+    "receive 1 message": ClientReceiveMessagesSchema(messages=[message()]),
+    "receive 50 messages": ClientReceiveMessagesSchema(messages=[message() for _ in range(50)]),
+    "preview 50 chats": GetPreviewReturn(chat_list=[
+        ChatPreview(user=UserInfo(id=uuid4(), nickname="nickname"), last_message=message(), count_unread_message=3)
+        for _ in range(50)
+    ]),
+    "read 20 messages": ClientReadMessagesSchema(list_messages_id=[uuid4() for _ in range(20)]),
+}
+
+
+def main():
+    for name, model in SCHEMAS.items():
+        # send_message serialized the frame for publish and again for the echo, then send_json encoded it once more
+        before = timeit.timeit(
+            lambda: (model.model_dump_json(), send_json(model.model_dump_json())), number=NUMBER,
+        )
+        after = timeit.timeit(lambda: dump(model), number=NUMBER)
+        print(f"{name:22} before {before / NUMBER * 1e6:9.2f} us   after {after / NUMBER * 1e6:9.2f} us")
+
+
+if __name__ == '__main__':
+    main()
@@ -7,7 +7,7 @@ from alembic import context
 
 from opti.core.database import DBase, DATABASE_URL
 from opti.auth.models import User
-from opti.chat.models import Message
+from opti.chat.models import Message, ConversationSummary
 
 config = context.config
 config.set_main_option('sqlalchemy.url', DATABASE_URL + "?async_fallback=True")
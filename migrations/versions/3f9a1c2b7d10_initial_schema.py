@@ -0,0 +1,57 @@
+"""initial schema
+
+Revision ID: 3f9a1c2b7d10
+Revises: 
+Create Date: 2026-10-18 09:12:41.508320
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '3f9a1c2b7d10'
+down_revision: Union[str, None] = None
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # the schema of the models before migrations were added, databases created by metadata.create_all
+    # from them are stamped here: `alembic stamp 3f9a1c2b7d10 && alembic upgrade head`
+    op.execute('CREATE EXTENSION IF NOT EXISTS "uuid-ossp"')
+    op.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    op.create_table(
+        'users',
+        sa.Column('id', sa.Uuid(), server_default=sa.text('uuid_generate_v4()'), nullable=False),
+        sa.Column('email', sa.String(), nullable=False),
+        sa.Column('nickname', sa.String(), nullable=False),
+        sa.Column('is_superuser', sa.Boolean(), server_default=sa.text('false'), nullable=False),
+        sa.Column('registered_at', sa.DateTime(), server_default=sa.text("TIMEZONE('utc', now())"), nullable=False),
+        sa.Column('is_blocked', sa.Boolean(), server_default=sa.text('false'), nullable=False),
+        sa.Column('online_at', sa.DateTime(), nullable=True),
+        sa.PrimaryKeyConstraint('id'),
+        sa.UniqueConstraint('email'),
+    )
+    op.create_index(
+        'idx_users_nickname_trgm', 'users', [sa.text('nickname gin_trgm_ops')], unique=False, postgresql_using='gin'
+    )
+    op.create_table(
+        'message',
+        sa.Column('id', sa.Uuid(), server_default=sa.text('uuid_generate_v4()'), nullable=False),
+        sa.Column('sender_id', sa.Uuid(), nullable=False),
+        sa.Column('recipient_id', sa.Uuid(), nullable=False),
+        sa.Column('message', sa.String(), nullable=False),
+        sa.Column('created_at', sa.DateTime(), server_default=sa.text("TIMEZONE('utc', now())"), nullable=False),
+        sa.Column('is_viewed', sa.Boolean(), server_default=sa.text('false'), nullable=False),
+        sa.ForeignKeyConstraint(['recipient_id'], ['users.id'], ondelete='CASCADE'),
+        sa.ForeignKeyConstraint(['sender_id'], ['users.id'], ondelete='CASCADE'),
+        sa.PrimaryKeyConstraint('id'),
+    )
+
+
+def downgrade() -> None:
+    op.drop_table('message')
+    op.drop_table('users')
@@ -0,0 +1,63 @@
+"""chat index and conversation summary
+
+Revision ID: 5e0d7b3a9c64
+Revises: 3f9a1c2b7d10
+Create Date: 2026-10-18 09:30:17.402615
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '5e0d7b3a9c64'
+down_revision: Union[str, None] = '3f9a1c2b7d10'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_index(
+        'idx_message_chat_created_at',
+        'message',
+        [sa.text('least(sender_id, recipient_id)'), sa.text('greatest(sender_id, recipient_id)'), 'created_at', 'id'],
+        unique=False,
+    )
+    # the table is created empty, fill it with `python -m opti.manage backfill-summary`
+    op.create_table(
+        'conversation_summary',
+        sa.Column('user_low_id', sa.Uuid(), nullable=False),
+        sa.Column('user_high_id', sa.Uuid(), nullable=False),
+        sa.Column('last_message_id', sa.Uuid(), nullable=False),
+        sa.Column('last_sender_id', sa.Uuid(), nullable=False),
+        sa.Column('last_message', sa.String(), nullable=False),
+        sa.Column('last_message_at', sa.DateTime(), nullable=False),
+        sa.Column('last_message_viewed', sa.Boolean(), server_default=sa.text('false'), nullable=False),
+        sa.Column('unread_low', sa.Integer(), server_default=sa.text('0'), nullable=False),
+        sa.Column('unread_high', sa.Integer(), server_default=sa.text('0'), nullable=False),
+        sa.Column('cleared_at', sa.DateTime(), nullable=True),
+        sa.Column('purge_pending', sa.Boolean(), server_default=sa.text('false'), nullable=False),
+        sa.ForeignKeyConstraint(['user_high_id'], ['users.id'], ondelete='CASCADE'),
+        sa.ForeignKeyConstraint(['user_low_id'], ['users.id'], ondelete='CASCADE'),
+        sa.PrimaryKeyConstraint('user_low_id', 'user_high_id'),
+    )
+    op.create_index(
+        'idx_conversation_summary_low_last', 'conversation_summary', ['user_low_id', 'last_message_at'], unique=False
+    )
+    op.create_index(
+        'idx_conversation_summary_high_last', 'conversation_summary', ['user_high_id', 'last_message_at'], unique=False
+    )
+    op.create_index(
+        'idx_conversation_summary_purge_pending',
+        'conversation_summary',
+        ['user_low_id', 'user_high_id'],
+        unique=False,
+        postgresql_where=sa.text('purge_pending'),
+    )
+
+
+def downgrade() -> None:
+    op.drop_table('conversation_summary')
+    op.drop_index('idx_message_chat_created_at', table_name='message')
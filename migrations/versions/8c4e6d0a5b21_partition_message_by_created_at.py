@@ -0,0 +1,83 @@
+"""partition message by created_at
+
+Revision ID: 8c4e6d0a5b21
+Revises: 5e0d7b3a9c64
+Create Date: 2026-10-18 09:47:03.115942
+
+"""
+from typing import Sequence, Union
+
+from alembic import context, op
+import sqlalchemy as sa
+
+from opti.chat.partitions import add_months, month_start, create_partition_sql, create_default_partition_sql
+from opti.core.config import MESSAGE_PARTITIONS_AHEAD
+from opti.core.utils import utc_now
+
+
+# revision identifiers, used by Alembic.
+revision: str = '8c4e6d0a5b21'
+down_revision: Union[str, None] = '5e0d7b3a9c64'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+COLUMNS = "id, sender_id, recipient_id, message, created_at, is_viewed"
+
+
+def rename_message_table() -> None:
+    '''free the names for the new table, its primary key and index'''
+    op.execute("ALTER TABLE message RENAME TO message_old")
+    op.execute("ALTER TABLE message_old RENAME CONSTRAINT message_pkey TO message_old_pkey")
+    op.execute("ALTER INDEX idx_message_chat_created_at RENAME TO idx_message_old_chat_created_at")
+
+
+def create_message_table(primary_key: sa.PrimaryKeyConstraint, **kwargs) -> None:
+    op.create_table(
+        'message',
+        sa.Column('id', sa.Uuid(), server_default=sa.text('uuid_generate_v4()'), nullable=False),
+        sa.Column('sender_id', sa.Uuid(), nullable=False),
+        sa.Column('recipient_id', sa.Uuid(), nullable=False),
+        sa.Column('message', sa.String(), nullable=False),
+        sa.Column('created_at', sa.DateTime(), server_default=sa.text("TIMEZONE('utc', now())"), nullable=False),
+        sa.Column('is_viewed', sa.Boolean(), server_default=sa.text('false'), nullable=False),
+        sa.ForeignKeyConstraint(['recipient_id'], ['users.id'], ondelete='CASCADE'),
+        sa.ForeignKeyConstraint(['sender_id'], ['users.id'], ondelete='CASCADE'),
+        primary_key,
+        **kwargs,
+    )
+    # on a partitioned table postgres creates it on every partition
+    op.create_index(
+        'idx_message_chat_created_at',
+        'message',
+        [sa.text('least(sender_id, recipient_id)'), sa.text('greatest(sender_id, recipient_id)'), 'created_at', 'id'],
+        unique=False,
+    )
+
+
+def upgrade() -> None:
+    rename_message_table()
+    create_message_table(
+        sa.PrimaryKeyConstraint('id', 'created_at'),
+        postgresql_partition_by='RANGE (created_at)',
+    )
+
+    first_message_at = None
+    if not context.is_offline_mode():
+        first_message_at = op.get_bind().execute(sa.text("SELECT min(created_at) FROM message_old")).scalar()
+    # with --sql older rows land in the default partition
+    month = month_start((first_message_at or utc_now()).date())
+    last_month = add_months(month_start(utc_now().date()), MESSAGE_PARTITIONS_AHEAD)
+    while month <= last_month:
+        op.execute(create_partition_sql(month))
+        month = add_months(month, 1)
+    op.execute(create_default_partition_sql())
+
+    op.execute(f"INSERT INTO message ({COLUMNS}) SELECT {COLUMNS} FROM message_old")
+    op.drop_table('message_old')
+
+
+def downgrade() -> None:
+    rename_message_table()
+    create_message_table(sa.PrimaryKeyConstraint('id'))
+    op.execute(f"INSERT INTO message ({COLUMNS}) SELECT {COLUMNS} FROM message_old")
+    op.drop_table('message_old')
@@ -1,18 +1,19 @@
 from uuid import UUID
 
-import aiohttp
 from fastapi import APIRouter, Depends, Response, HTTPException, Request
 from fastapi.security import OAuth2AuthorizationCodeBearer
-from sqlalchemy import select
+from sqlalchemy.dialects.postgresql import insert
 from starlette import status
 
 from opti.auth.scheme import FetchGoogleClientId
 from opti.core.database import async_session_maker
 from opti.auth.jwt import create_token, decode_google_token
 from opti.auth.models import User
+from opti.auth.service import email_cache, email_key, user_is_active
+from opti.core.http import get_http_client
 from opti.core.redis import get_redis
 from opti.core.utils import create_nickname_from_email
-from opti.core.config import logger, GOOGLE_CLIENT_ID
+from opti.core.config import logger, GOOGLE_CLIENT_ID, GOOGLE_USERINFO_URL, VALID_USER_REDIS_TTL
 
 auth = APIRouter(
     prefix='/auth',
@@ -30,26 +31,46 @@ oauth2_scheme = OAuth2AuthorizationCodeBearer(
 )
 
 
+BLOCKED_EXCEPTION = HTTPException(
+    status_code=status.HTTP_403_FORBIDDEN,
+    detail='User has been blocked'
+)
+
+
 async def get_id_from_email(email: str) -> UUID:
+    if (user_id := email_cache.get(email)) is not None:
+        return user_id
+    redis = get_redis()
+    key = email_key(email)
+    if (cached := await redis.get(key)) is not None:
+        user_id, is_blocked = cached.split(':')
+        if is_blocked == '1':
+            raise BLOCKED_EXCEPTION
+        user_id = UUID(user_id)
+        email_cache.set(email, user_id)
+        return user_id
+
+    query = insert(User).values(
+        email=email,
+        nickname=create_nickname_from_email(email),
+    )
+    query = query.on_conflict_do_update(
+        index_elements=[User.email],
+        set_={'email': query.excluded.email},
+    ).returning(User.id, User.is_blocked)
     async with async_session_maker() as session:
-        query = select(User).where(User.email == email)
-        user = await session.execute(query)
-        user: User = user.scalar()
-        if user is not None and user.is_blocked:
-            logger.info(f'User {user.id} trying pass.')
-            raise HTTPException(
-                status_code=status.HTTP_403_FORBIDDEN,
-                detail='User has been blocked'
-            )
-        if user is None:
-            new_user = User(
-                email=email,
-                nickname=create_nickname_from_email(email),
-            )
-            session.add(new_user)
-            await session.commit()
-            user = new_user
-        return user.id
+        user_id, is_blocked = (await session.execute(query)).one()
+        await session.commit()
+    await redis.set(key, f"{user_id}:{int(is_blocked)}", ex=VALID_USER_REDIS_TTL)
+    # a block committed after the upsert could have run invalidate_user before the set, check again
+    if not is_blocked and not await user_is_active(user_id):
+        await redis.delete(key)
+        is_blocked = True
+    if is_blocked:
+        logger.info('User {} trying pass.', user_id)
+        raise BLOCKED_EXCEPTION
+    email_cache.set(email, user_id)
+    return user_id
 
 
 @auth.get('/googleclientid', response_model=FetchGoogleClientId)
@@ -65,10 +86,8 @@ async def get_google_code(
     user_info = await decode_google_token(token)
     email = user_info.get('email')
     user_id = await get_id_from_email(email)
-    redis = get_redis()
-    await redis.sadd('valid_id', str(user_id))
     response.set_cookie('jwt', create_token(str(user_id)), secure=True, httponly=True, samesite=None)
-    logger.debug(f"get google token for {user_id}")
+    logger.debug("get google token for {}", user_id)
 
 
 @auth.get('/set_token_in_cookie')
@@ -83,17 +102,14 @@ async def set_token_in_cookie(
     if request.url.path == "/docs-only-endpoint":
         raise HTTPException(status_code=403, detail="Forbidden")
 
-    async with aiohttp.ClientSession() as session:
-        async with session.get('https://www.googleapis.com/oauth2/v3/userinfo',
-                               headers={'Authorization': f'Bearer {token}'}) as http_response:
-            http_response.raise_for_status()
-            user_info = await http_response.json()
+    async with get_http_client().get(GOOGLE_USERINFO_URL,
+                                     headers={'Authorization': f'Bearer {token}'}) as http_response:
+        http_response.raise_for_status()
+        user_info = await http_response.json()
 
     email = user_info.get('email')
     user_id = await get_id_from_email(email)
-    redis = get_redis()
-    await redis.sadd('valid_id', str(user_id))
     token = create_token(str(user_id))
     response.set_cookie('jwt', token, secure=True, httponly=True)
-    logger.debug(f"get token for {email}")
+    logger.debug("get token for {}", email)
     return {"token": token}
@@ -1,13 +1,16 @@
+import asyncio
+import json
+import re
+import time
 from datetime import timedelta
 
-import aiohttp
-from aiocache import cached, Cache
 from jose import jwt as _jwt, JWTError, jwk
-from jose.utils import base64url_decode
+from jose.backends.base import Key
 
+from opti.core.http import get_http_client
 from opti.core.utils import utc_now
-from opti.core.config import SECRET_KEY, API_ACCESS_TOKEN_EXPIRE_MINUTES, GOOGLE_CLIENT_ID, GOOGLE_CERTS_URL, \
-    GOOGLE_CERTS_TTL
+from opti.core.config import logger, SECRET_KEY, API_ACCESS_TOKEN_EXPIRE_MINUTES, GOOGLE_CLIENT_ID, \
+    GOOGLE_CERTS_URL, GOOGLE_CERTS_TTL, GOOGLE_CERTS_REFRESH_AHEAD, GOOGLE_CERTS_RETRY, GOOGLE_JWKS_FILE
 
 
 def create_access_token(*, data: dict, expires_delta: timedelta = None):
@@ -36,32 +39,84 @@ def decode_token(token):
     return _jwt.decode(token, SECRET_KEY, algorithms=['HS256'])
 
 
-@cached(cache=Cache.MEMORY, ttl=GOOGLE_CERTS_TTL)
-async def get_google_certificates():
-    async with aiohttp.ClientSession() as session:
-        async with session.get(GOOGLE_CERTS_URL) as response:
+class GoogleKeyStore:
+    '''
+    Google signing keys constructed once and indexed by kid.
+    Keys are refreshed in background before the max-age of the certs response runs out,
+    with jwks_file the keys are loaded from a local JWKS file and never refreshed.
+    '''
+
+    def __init__(self, url: str, jwks_file: str | None = None):
+        self.url = url
+        self.jwks_file = jwks_file
+        self.keys: dict[str, Key] = {}
+        self.expires_at = 0.0
+        self.refreshed_at = 0.0
+        self.lock = asyncio.Lock()
+        self.task: asyncio.Task | None = None
+
+    async def start(self):
+        try:
+            await self.refresh()
+        except Exception as e:
+            logger.error("google certs fetch failed: {}", e)
+        if self.jwks_file is None:
+            self.task = asyncio.create_task(self.refresh_loop())
+
+    async def close(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+
+    async def fetch(self) -> tuple[list[dict], int]:
+        if self.jwks_file is not None:
+            with open(self.jwks_file) as f:
+                return json.load(f)["keys"], 0
+        async with get_http_client().get(self.url) as response:
             response.raise_for_status()
             data = await response.json()
-    public_keys = data["keys"]
-    return public_keys
+            max_age = re.search(r"max-age=(\d+)", response.headers.get("Cache-Control", ""))
+        return data["keys"], int(max_age.group(1)) if max_age else GOOGLE_CERTS_TTL
+
+    async def refresh(self):
+        public_keys, max_age = await self.fetch()
+        self.keys = {key["kid"]: jwk.construct(key, key.get("alg", "RS256")) for key in public_keys}
+        now = time.monotonic()
+        self.refreshed_at = now
+        self.expires_at = now + max_age
+
+    async def refresh_loop(self):
+        while True:
+            ttl = self.expires_at - time.monotonic()
+            await asyncio.sleep(max(ttl - max(ttl * 0.1, GOOGLE_CERTS_REFRESH_AHEAD), GOOGLE_CERTS_RETRY))
+            try:
+                await self.refresh()
+            except Exception as e:
+                logger.error("google certs refresh failed: {}", e)
+
+    async def get_key(self, kid: str) -> Key | None:
+        if (key := self.keys.get(kid)) is not None:
+            return key
+        # google could rotate keys before our copy expires, refetch but not on every unknown kid
+        async with self.lock:
+            if kid not in self.keys and self.jwks_file is None \
+                    and time.monotonic() - self.refreshed_at > GOOGLE_CERTS_RETRY:
+                await self.refresh()
+        return self.keys.get(kid)
+
+
+google_key_store = GoogleKeyStore(GOOGLE_CERTS_URL, GOOGLE_JWKS_FILE)
 
 
 async def decode_google_token(token: str):
     unverified_header = _jwt.get_unverified_header(token)
-    public_keys = await get_google_certificates()
+    public_key = await google_key_store.get_key(unverified_header.get('kid'))
+    if public_key is None:
+        raise JWTError("Unknown signing key")
 
-    public_key = None
-    for key in public_keys:
-        if key['kid'] == unverified_header['kid']:
-            public_key = key
-
-    rsa_key = jwk.construct(public_key)
-    message, encoded_sig = token.rsplit('.', 1)
-    decoded_sig = base64url_decode(encoded_sig.encode('utf-8'))
-
-    if not rsa_key.verify(message.encode("utf8"), decoded_sig):
-        raise JWTError("Signature verification failed")
-
-    payload = _jwt.decode(token, rsa_key.to_pem().decode('utf-8'), algorithms=['RS256'],
-                         audience=GOOGLE_CLIENT_ID, issuer="https://accounts.google.com")
+    payload = _jwt.decode(token, public_key, algorithms=['RS256'],
+                          audience=GOOGLE_CLIENT_ID, issuer="https://accounts.google.com")
     return payload
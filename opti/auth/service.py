@@ -1,13 +1,22 @@
+import hashlib
+import json
+import time
 from uuid import UUID
 
 from fastapi import Depends, HTTPException
 from fastapi.security import APIKeyCookie
 from jose import JWTError
+from sqlalchemy import update, select
+from sqlalchemy.ext.asyncio import AsyncSession
 from starlette import status
 
 from opti.auth.jwt import decode_token
 from opti.auth.models import User
+from opti.core.cache import TTLCache
+from opti.core.config import logger, TOKEN_CACHE_SIZE, VALID_USER_CACHE_SIZE, VALID_USER_CACHE_TTL, \
+    USER_INVALIDATION_CHANNEL, VALID_USER_REDIS_TTL
 from opti.core.database import async_session_maker
+from opti.core.pubsub import get_pubsub, publish
 from opti.core.redis import get_redis
 
 
@@ -16,31 +25,105 @@ CREDENTIALS_EXCEPTION = HTTPException(
     detail='Could not validate credentials',
     headers={'WWW-Authenticate': 'Bearer'},
 )
+# sha256(token) -> user id from sub, entries live until the token expires
+token_cache = TTLCache("auth.token_cache", TOKEN_CACHE_SIZE)
+# ids of valid users in front of redis valid_id:<id> keys, cleared through USER_INVALIDATION_CHANNEL
+valid_user_cache = TTLCache("auth.valid_user_cache", VALID_USER_CACHE_SIZE, VALID_USER_CACHE_TTL)
+# email -> id of not blocked user in front of redis email_id:<email> keys, cleared with valid_user_cache
+email_cache = TTLCache("auth.email_cache", VALID_USER_CACHE_SIZE, VALID_USER_CACHE_TTL)
+
+
+def valid_user_key(user_id: UUID | str) -> str:
+    return f"valid_id:{user_id}"
+
+
+def email_key(email: str) -> str:
+    '''"<user_id>:<1 if blocked else 0>", expires after VALID_USER_REDIS_TTL'''
+    return f"email_id:{email}"
+
+
+async def user_is_active(user_id: UUID) -> bool:
+    async with async_session_maker() as session:
+        is_blocked = await session.scalar(select(User.is_blocked).where(User.id == user_id))
+    return is_blocked is False
 
 
 async def valid_user_from_db(user_id: UUID) -> bool:
+    if valid_user_cache.get(user_id):
+        return True
     redis = get_redis()
-    if await redis.sismember('valid_id', str(user_id)):
+    key = valid_user_key(user_id)
+    if await redis.exists(key):
+        valid_user_cache.set(user_id, True)
         return True
-    async with async_session_maker() as session:
-        user = await session.get(User, user_id)
-        if user is not None and not user.is_blocked:
-            await redis.sadd('valid_id', str(user_id))
-            return True
+    if not await user_is_active(user_id):
+        return False
+    await redis.set(key, 1, ex=VALID_USER_REDIS_TTL)
+    # a block committed after the check above could have run invalidate_user before the set, check again
+    if not await user_is_active(user_id):
+        await redis.delete(key)
+        return False
+    valid_user_cache.set(user_id, True)
+    return True
 
 
-async def get_current_user_id(
-    token: str = Depends(APIKeyCookie(name='jwt'))
-) -> UUID:
+async def invalidate_user(user_id: UUID, email: str | None = None):
+    '''call after the user is blocked or deleted in db, drops them from validity caches of every worker'''
+    redis = get_redis()
+    valid_user_cache.pop(user_id)
+    await redis.delete(valid_user_key(user_id))
+    if email is not None:
+        email_cache.pop(email)
+        await redis.delete(email_key(email))
+    await publish(USER_INVALIDATION_CHANNEL, json.dumps({"user_id": str(user_id), "email": email}))
+
+
+def on_user_invalidated(data: str):
+    try:
+        message = json.loads(data)
+        user_id = UUID(message["user_id"])
+    except (ValueError, KeyError, TypeError) as e:
+        logger.warning("invalid user invalidation message {!r}: {}", data, e)
+        return
+    valid_user_cache.pop(user_id)
+    if (email := message.get("email")) is not None:
+        email_cache.pop(email)
+
+
+async def subscribe_user_invalidation():
+    await get_pubsub().subscribe(USER_INVALIDATION_CHANNEL, on_user_invalidated)
+
+
+async def block_user(session: AsyncSession, user_id: UUID):
+    result = await session.execute(
+        update(User).values(is_blocked=True).where(User.id == user_id).returning(User.email)
+    )
+    email = result.scalar()
+    await session.commit()
+    await invalidate_user(user_id, email)
+
+
+def user_id_from_token(token: str) -> UUID:
+    key = hashlib.sha256(token.encode()).digest()
+    if (user_id := token_cache.get(key)) is not None:
+        return user_id
+
     try:
         payload = decode_token(token)
-        user_id: str = payload.get('sub')
-        if user_id is None:
-            raise CREDENTIALS_EXCEPTION
-    except JWTError:
+        user_id = UUID(payload['sub'])
+    except (JWTError, KeyError, TypeError, ValueError):
         raise CREDENTIALS_EXCEPTION
+    if (expire := payload.get('exp')) is not None:
+        token_cache.set(key, user_id, ttl=expire - time.time())
+    return user_id
 
-    user_id: UUID = UUID(user_id)
+
+async def get_current_user_id(
+    token: str = Depends(APIKeyCookie(name='jwt'))
+) -> UUID:
+    if not token:
+        raise CREDENTIALS_EXCEPTION
+    user_id = user_id_from_token(token)
 
     if await valid_user_from_db(user_id):
         return user_id
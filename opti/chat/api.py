@@ -1,21 +1,22 @@
 from uuid import UUID
 import json
-import asyncio
 from fastapi import APIRouter, WebSocket, WebSocketDisconnect
-from pydantic import ValidationError
 
+from opti.chat.connection import ChatConnection
+from opti.chat.registry import chat_connections
+from opti.chat.dispatcher import ActionDispatcher, action_metrics_hook
 from opti.chat.schema import (
     SendMessageSchema,
     GetChatSchema,
-    ServerActionType,
     DeleteChatScheme, ReadMessagesSchema,
 )
 from opti.chat.service import send_message, get_chat, get_preview, delete_chat, read_message, user_status_online, \
     user_status_offline
 from opti.chat.utils import WebsocketError
 from opti.core.database import async_session_maker
-from opti.core.redis import get_redis
+from opti.core.pubsub import get_pubsub
 from opti.core.config import logger
+from opti.core.log import ThrottledLogger
 from opti.auth.service import get_current_user_id
 
 
@@ -24,55 +25,35 @@ chat = APIRouter(
     tags=["chat"],
 )
 
+INVALID_JSON_PAYLOAD = json.dumps({"error": "invalid json"})
 
-async def chat_input_handler(
-    websocket: WebSocket,
-    user_id: UUID,
-):
-    async with async_session_maker() as db_session:
-        await get_preview(websocket, db_session, user_id)
-        while True:
-            try:
-                ws_data: dict = await websocket.receive_json()
-                try:
-                    action_type = ServerActionType(ws_data.get("action_type"))
-                except ValueError:
-                    raise WebsocketError('invalid action')
-                logger.debug(f"ws: {user_id}: {action_type.value}")
-
-                action_list = {
-                    ServerActionType.get_chat: (get_chat, GetChatSchema),
-                    ServerActionType.send_message: (send_message, SendMessageSchema),
-                    ServerActionType.read_messages: (read_message, ReadMessagesSchema),
-                    ServerActionType.delete_chat: (delete_chat, DeleteChatScheme),
-                }
+websocket_errors = ThrottledLogger(interval=1.0)
 
-                func, schema = action_list[action_type]
+dispatcher = ActionDispatcher()
+dispatcher.register(GetChatSchema, get_chat)
+dispatcher.register(SendMessageSchema, send_message)
+dispatcher.register(ReadMessagesSchema, read_message)
+dispatcher.register(DeleteChatScheme, delete_chat)
+dispatcher.add_timing_hook(action_metrics_hook)
 
-                try:
-                    data = schema.model_validate(ws_data)
-                except (KeyError, ValueError, ValidationError) as e:
-                    raise WebsocketError(e)
-                await func(websocket, db_session, user_id, data)
 
-
-            except (WebsocketError, json.decoder.JSONDecodeError, ValueError) as e:
-                await websocket.send_json({"error": "invalid json"})
-                logger.warning(f"websocket error: {e}")
-                continue
-
-
-async def chat_output_handler(
-    websocket: WebSocket,
+async def chat_input_handler(
+    connection: ChatConnection,
     user_id: UUID,
 ):
-    redis = get_redis()
-    async with redis.pubsub() as subscribe:
-        await subscribe.psubscribe(str(user_id))
-        async for msg in subscribe.listen():
-            if msg["type"] == "pmessage":
-                data = msg.get("data")
-                await websocket.send_json(data)
+    websocket = connection.websocket
+    # a session per action: a pooled connection is held only while an action runs, not for the socket life
+    async with async_session_maker() as db_session:
+        await get_preview(connection, db_session, user_id)
+    while not connection.closed:
+        raw = await websocket.receive_text()
+        try:
+            async with async_session_maker() as db_session:
+                await dispatcher.dispatch(connection, db_session, user_id, raw)
+        except (WebsocketError, KeyError, ValueError) as e:
+            connection.send(INVALID_JSON_PAYLOAD)
+            websocket_errors.warning("websocket error: {}", e)
+            continue
 
 
 @chat.websocket("/ws")
@@ -82,13 +63,20 @@ async def chat_websocket(
     user_id: UUID = await get_current_user_id(token=websocket.cookies.get("jwt"))
     await websocket.accept()
     await user_status_online(user_id)
-    logger.debug(f"Open websocket for {user_id}")
+    logger.debug("Open websocket for {}", user_id)
 
+    pubsub = get_pubsub()
+    connection = ChatConnection(websocket, user_id)
     try:
-        await asyncio.gather(
-            chat_input_handler(websocket, user_id),
-            chat_output_handler(websocket, user_id),
-        )
+        # every step below is undone by the finally block even if a later one fails
+        connection.start()
+        chat_connections.add(connection)
+        await pubsub.subscribe(str(user_id), connection.send)
+        await chat_input_handler(connection, user_id)
     except WebSocketDisconnect:
+        logger.debug("Websocket close for {}", user_id)
+    finally:
+        chat_connections.discard(connection)
+        await pubsub.unsubscribe(str(user_id), connection.send)
+        await connection.close()
         await user_status_offline(user_id)
-        logger.debug(f"Websocket close for {user_id}")
@@ -0,0 +1,127 @@
+import asyncio
+import time
+
+from sqlalchemy import insert, func
+
+from opti.chat.models import Message
+from opti.chat.summary import summary_on_send
+from opti.core import metrics
+from opti.core.config import logger, MESSAGE_BATCH_ENABLED, MESSAGE_BATCH_MAX_ROWS, MESSAGE_BATCH_MAX_DELAY
+from opti.core.database import async_session_maker
+
+
+BATCH_SIZE_BUCKETS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000)
+
+batch_size = metrics.histogram("message_batch.size", BATCH_SIZE_BUCKETS)
+flush_seconds = metrics.histogram("message_batch.flush_seconds")
+flush_errors = metrics.counter("message_batch.errors")
+
+
+class MessageBatcher:
+    '''
+    Write-behind buffer for new messages of the whole worker.
+    Rows are written with one multi-row INSERT and one commit when max_rows are collected
+    or max_delay seconds passed since the first pending row, submit() returns after that commit.
+    '''
+
+    def __init__(self, max_rows: int, max_delay: float):
+        self.max_rows = max_rows
+        self.max_delay = max_delay
+        self.pending: list[tuple[Message, asyncio.Future]] = []
+        self.has_rows = asyncio.Event()
+        self.full = asyncio.Event()
+        self.closing = False
+        self.task: asyncio.Task | None = None
+
+    def start(self):
+        self.task = asyncio.create_task(self.run())
+
+    async def submit(self, message: Message):
+        if self.closing:
+            raise RuntimeError("message batcher is closed")
+        future = asyncio.get_running_loop().create_future()
+        self.pending.append((message, future))
+        self.has_rows.set()
+        if len(self.pending) >= self.max_rows:
+            self.full.set()
+        await future
+
+    async def run(self):
+        while not (self.closing and not self.pending):
+            await self.has_rows.wait()
+            if not self.closing and len(self.pending) < self.max_rows:
+                try:
+                    await asyncio.wait_for(self.full.wait(), self.max_delay)
+                except asyncio.TimeoutError:
+                    pass
+            await self.flush()
+
+    async def flush(self):
+        batch = self.pending[:self.max_rows]
+        del self.pending[:self.max_rows]
+        if len(self.pending) < self.max_rows:
+            self.full.clear()
+        if not self.pending:
+            self.has_rows.clear()
+        if not batch:
+            return
+
+        started = time.perf_counter()
+        try:
+            await self.write([message for message, _ in batch])
+        except Exception as e:
+            flush_errors.inc()
+            logger.error("message batch of {} failed: {}", len(batch), e)
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+        else:
+            for _, future in batch:
+                if not future.done():
+                    future.set_result(None)
+        batch_size.observe(len(batch))
+        flush_seconds.observe(time.perf_counter() - started)
+
+    @staticmethod
+    async def write(messages: list[Message]):
+        async with async_session_maker() as session:
+            await session.execute(insert(Message).values([
+                {
+                    "id": message.id,
+                    "sender_id": message.sender_id,
+                    "recipient_id": message.recipient_id,
+                    "message": message.message,
+                    "created_at": message.created_at or func.timezone('utc', func.now()),
+                }
+                for message in messages
+            ]))
+            await summary_on_send(session, messages)
+            await session.commit()
+
+    async def close(self):
+        self.closing = True
+        self.has_rows.set()
+        self.full.set()
+        if self.task is not None:
+            await self.task
+
+
+batcher: MessageBatcher | None = None
+
+
+async def init_message_batcher():
+    global batcher
+    if MESSAGE_BATCH_ENABLED:
+        batcher = MessageBatcher(MESSAGE_BATCH_MAX_ROWS, MESSAGE_BATCH_MAX_DELAY)
+        batcher.start()
+
+
+async def shutdown_message_batcher():
+    global batcher
+    if batcher is not None:
+        await batcher.close()
+
+
+def get_message_batcher() -> MessageBatcher | None:
+    global batcher
+    return batcher
@@ -0,0 +1,141 @@
+import asyncio
+import json
+from collections import deque
+from enum import Enum
+from uuid import UUID
+
+from pydantic import BaseModel
+from starlette.websockets import WebSocket
+
+from opti.chat.schema import ClientReadMessagesSchema, ClientResyncSchema, ClientActionType
+from opti.chat.serialization import dump
+from opti.core import metrics
+from opti.core.config import logger, OUTBOX_SIZE, OUTBOX_POLICY
+
+
+READ_MESSAGES_PREFIX = f'{{"action_type":"{ClientActionType.read_messages.value}"'
+RESYNC_PAYLOAD = dump(ClientResyncSchema())
+CLOSE_TRY_AGAIN_LATER = 1013
+
+queued = metrics.gauge("chat.outbox.queued")
+overflows = metrics.counter("chat.outbox.overflows")
+coalesced = metrics.counter("chat.outbox.coalesced")
+dropped = metrics.counter("chat.outbox.dropped")
+evictions = metrics.counter("chat.outbox.evictions")
+
+
+class OverflowPolicy(str, Enum):
+    '''what to do when the client does not read fast enough and its outbox is full'''
+    coalesce = "coalesce"  # merge read receipts into one frame, resync on other frames
+    resync = "resync"  # drop queued frames and ask client to reload
+    disconnect = "disconnect"  # close the socket
+
+
+class ChatConnection:
+    '''
+    Websocket of a chat client with a bounded outbound queue.
+    send() never waits for the client, frames are written by a dedicated writer task.
+    '''
+
+    def __init__(
+        self,
+        websocket: WebSocket,
+        user_id: UUID,
+        maxsize: int = OUTBOX_SIZE,
+        policy: OverflowPolicy = OverflowPolicy(OUTBOX_POLICY),
+    ):
+        self.websocket = websocket
+        self.user_id = user_id
+        self.maxsize = maxsize
+        self.policy = policy
+        self.outbox: deque[str] = deque()
+        self.read_ids: dict[str, None] = {}
+        self.resync = False
+        self.closed = False
+        self.wakeup = asyncio.Event()
+        self.writer: asyncio.Task | None = None
+        # the loop keeps only weak references to tasks
+        self.tasks: set[asyncio.Task] = set()
+
+    @property
+    def depth(self) -> int:
+        return len(self.outbox)
+
+    def start(self):
+        self.writer = asyncio.create_task(self.write())
+
+    def send(self, payload: str):
+        if self.closed:
+            return
+        if len(self.outbox) < self.maxsize:
+            self.outbox.append(payload)
+            queued.inc()
+            self.wakeup.set()
+            return
+
+        overflows.inc()
+        if self.policy == OverflowPolicy.disconnect:
+            self.evict()
+            return
+        if self.policy == OverflowPolicy.coalesce and payload.startswith(READ_MESSAGES_PREFIX):
+            self.read_ids.update(dict.fromkeys(json.loads(payload)["list_messages_id"]))
+            coalesced.inc()
+        else:
+            dropped.inc(len(self.outbox) + 1)
+            queued.dec(len(self.outbox))
+            self.outbox.clear()
+            self.read_ids.clear()
+            self.resync = True
+        self.wakeup.set()
+
+    def send_model(self, model: BaseModel) -> str:
+        payload = dump(model)
+        self.send(payload)
+        return payload
+
+    def evict(self):
+        if self.closed:
+            return
+        self.closed = True
+        evictions.inc()
+        logger.warning("evict slow websocket of {}", self.user_id)
+        task = asyncio.create_task(self.close(code=CLOSE_TRY_AGAIN_LATER))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def write(self):
+        while True:
+            await self.wakeup.wait()
+            self.wakeup.clear()
+            while True:
+                if self.resync:
+                    self.resync = False
+                    payload = RESYNC_PAYLOAD
+                elif self.outbox:
+                    payload = self.outbox.popleft()
+                    queued.dec()
+                elif self.read_ids:
+                    payload = dump(ClientReadMessagesSchema(list_messages_id=list(self.read_ids)))
+                    self.read_ids.clear()
+                else:
+                    break
+                try:
+                    await self.websocket.send_text(payload)
+                except Exception as e:
+                    # socket is gone, the input side will see the disconnect
+                    logger.debug("websocket write failed for {}: {}", self.user_id, e)
+                    self.closed = True
+                    return
+
+    async def close(self, code: int | None = None):
+        self.closed = True
+        queued.dec(len(self.outbox))
+        self.outbox.clear()
+        if self.writer is not None:
+            self.writer.cancel()
+            self.writer = None
+        if code is not None:
+            try:
+                await self.websocket.close(code=code)
+            except RuntimeError:
+                pass
@@ -0,0 +1,66 @@
+import time
+from typing import Annotated, Awaitable, Callable, Union
+from uuid import UUID
+
+from pydantic import Field, TypeAdapter, ValidationError
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from opti.chat.connection import ChatConnection
+from opti.chat.schema import BaseAction, ServerActionType
+from opti.chat.utils import WebsocketError
+from opti.core import metrics
+
+
+Handler = Callable[[ChatConnection, AsyncSession, UUID, BaseAction], Awaitable[None]]
+TimingHook = Callable[[ServerActionType, float], None]
+
+
+class ActionDispatcher:
+    '''
+    Routes incoming websocket frames to registered handlers.
+    A frame is validated in one pass by a TypeAdapter over the union of registered schemas
+    discriminated on action_type, the adapter is built once after registration.
+    '''
+
+    def __init__(self):
+        self.handlers: dict[ServerActionType, Handler] = {}
+        self.schemas: list[type[BaseAction]] = []
+        self.timing_hooks: list[TimingHook] = []
+        self._adapter: TypeAdapter | None = None
+
+    def register(self, schema: type[BaseAction], handler: Handler):
+        action_type = schema.model_fields['action_type'].default
+        if not isinstance(action_type, ServerActionType):
+            raise TypeError(f"{schema.__name__} is not a server action")
+        self.handlers[action_type] = handler
+        self.schemas.append(schema)
+        self._adapter = None
+
+    def add_timing_hook(self, hook: TimingHook):
+        self.timing_hooks.append(hook)
+
+    @property
+    def adapter(self) -> TypeAdapter:
+        if self._adapter is None:
+            self._adapter = TypeAdapter(Annotated[Union[tuple(self.schemas)], Field(discriminator='action_type')])
+        return self._adapter
+
+    def parse(self, raw: str | bytes) -> BaseAction:
+        try:
+            return self.adapter.validate_json(raw)
+        except ValidationError as e:
+            raise WebsocketError(e)
+
+    async def dispatch(self, connection: ChatConnection, db_session: AsyncSession, user_id: UUID, raw: str | bytes):
+        data = self.parse(raw)
+        started = time.perf_counter()
+        try:
+            await self.handlers[data.action_type](connection, db_session, user_id, data)
+        finally:
+            elapsed = time.perf_counter() - started
+            for hook in self.timing_hooks:
+                hook(data.action_type, elapsed)
+
+
+def action_metrics_hook(action_type: ServerActionType, elapsed: float):
+    metrics.histogram(f"chat.action.{action_type.value}.seconds").observe(elapsed)
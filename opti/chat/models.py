@@ -1,21 +1,61 @@
+from datetime import datetime
 from uuid import UUID
-from sqlalchemy import ForeignKey, text
+from sqlalchemy import ForeignKey, text, Index
 from sqlalchemy.orm import Mapped, mapped_column, relationship
 
-from opti.auth.models import uuidpk, created_at_c, User
+from opti.auth.models import uuidpk, User
 from opti.core.database import DBase
 
 
 class Message(DBase):
+    '''range partitioned by month of created_at, partitions are managed by opti.chat.partitions'''
     __tablename__ = "message"
 
     id: Mapped[uuidpk]
     sender_id: Mapped[UUID] = mapped_column(ForeignKey('users.id', ondelete='CASCADE'))
     recipient_id: Mapped[UUID] = mapped_column(ForeignKey('users.id', ondelete='CASCADE'))
     message: Mapped[str] = mapped_column()
-    created_at: Mapped[created_at_c]
+    # part of the primary key, a unique constraint of a partitioned table must contain the partition key
+    created_at: Mapped[datetime] = mapped_column(primary_key=True, server_default=text("TIMEZONE('utc', now())"))
     is_viewed: Mapped[bool] = mapped_column(server_default=text("false"))
     # sender: Mapped["User"] = relationship(foreign_keys=[sender_id], back_populates='messages_sent')
     # recipient: Mapped["User"] = relationship(foreign_keys=[recipient_id], back_populates='messages_received')
 
+    __table_args__ = (
+        Index(
+            'idx_message_chat_created_at',
+            text("least(sender_id, recipient_id)"),
+            text("greatest(sender_id, recipient_id)"),
+            'created_at',
+            'id',
+        ),
+        {'postgresql_partition_by': 'RANGE (created_at)'},
+    )
 
+
+class ConversationSummary(DBase):
+    '''one row per pair of users, user_low_id < user_high_id'''
+    __tablename__ = "conversation_summary"
+
+    user_low_id: Mapped[UUID] = mapped_column(ForeignKey('users.id', ondelete='CASCADE'), primary_key=True)
+    user_high_id: Mapped[UUID] = mapped_column(ForeignKey('users.id', ondelete='CASCADE'), primary_key=True)
+    last_message_id: Mapped[UUID] = mapped_column()
+    last_sender_id: Mapped[UUID] = mapped_column()
+    last_message: Mapped[str] = mapped_column()
+    last_message_at: Mapped[datetime] = mapped_column()
+    last_message_viewed: Mapped[bool] = mapped_column(server_default=text("false"))
+    unread_low: Mapped[int] = mapped_column(server_default=text("0"))
+    unread_high: Mapped[int] = mapped_column(server_default=text("0"))
+    # messages created before are deleted for both users, purge_pending until they are gone from the table
+    cleared_at: Mapped[datetime] = mapped_column(nullable=True)
+    purge_pending: Mapped[bool] = mapped_column(server_default=text("false"))
+
+    __table_args__ = (
+        Index('idx_conversation_summary_low_last', 'user_low_id', 'last_message_at'),
+        Index('idx_conversation_summary_high_last', 'user_high_id', 'last_message_at'),
+        Index(
+            'idx_conversation_summary_purge_pending',
+            'user_low_id', 'user_high_id',
+            postgresql_where=text("purge_pending"),
+        ),
+    )
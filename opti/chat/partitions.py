@@ -0,0 +1,115 @@
+import gzip
+import os
+import re
+from datetime import date
+
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from opti.core.config import logger, MESSAGE_PARTITIONS_AHEAD
+from opti.core.utils import utc_now
+
+
+PARTITION_PREFIX = "message_p"
+DEFAULT_PARTITION = "message_default"
+PARTITION_NAME = re.compile(rf"^{PARTITION_PREFIX}(\d{{4}})(\d{{2}})$")
+
+LIST_PARTITIONS_QUERY = text("""
+    SELECT child.relname
+    FROM pg_inherits
+    JOIN pg_class child ON child.oid = pg_inherits.inhrelid
+    WHERE pg_inherits.inhparent = 'message'::regclass
+""")
+
+
+def month_start(day: date) -> date:
+    return day.replace(day=1)
+
+
+def add_months(month: date, months: int) -> date:
+    index = month.year * 12 + month.month - 1 + months
+    return date(index // 12, index % 12 + 1, 1)
+
+
+def partition_name(month: date) -> str:
+    return f"{PARTITION_PREFIX}{month:%Y%m}"
+
+
+def partition_month(name: str) -> date | None:
+    match = PARTITION_NAME.match(name)
+    if match is None:
+        return None
+    return date(int(match[1]), int(match[2]), 1)
+
+
+def create_partition_sql(month: date) -> str:
+    # indexes and foreign keys of the parent are created on the partition by postgres
+    return (
+        f"CREATE TABLE IF NOT EXISTS {partition_name(month)} PARTITION OF message "
+        f"FOR VALUES FROM ('{month.isoformat()}') TO ('{add_months(month, 1).isoformat()}')"
+    )
+
+
+def create_default_partition_sql() -> str:
+    return f"CREATE TABLE IF NOT EXISTS {DEFAULT_PARTITION} PARTITION OF message DEFAULT"
+
+
+async def list_partitions(db_session: AsyncSession) -> dict[date, str]:
+    result = await db_session.execute(LIST_PARTITIONS_QUERY)
+    partitions = {}
+    for name, in result.all():
+        if (month := partition_month(name)) is not None:
+            partitions[month] = name
+    return dict(sorted(partitions.items()))
+
+
+async def ensure_partitions(db_session: AsyncSession, ahead: int = MESSAGE_PARTITIONS_AHEAD) -> list[str]:
+    '''
+    Partitions from the current month to `ahead` months later, created before the first row needs them.
+    Rows outside of them land in the default partition, which blocks creating a partition for their month.
+    '''
+    existing = await list_partitions(db_session)
+    current = month_start(utc_now().date())
+    created = []
+    for month in (add_months(current, i) for i in range(ahead + 1)):
+        if month not in existing:
+            await db_session.execute(text(create_partition_sql(month)))
+            created.append(partition_name(month))
+    await db_session.execute(text(create_default_partition_sql()))
+    await db_session.commit()
+
+    if created:
+        logger.info("created message partitions: {}", ", ".join(created))
+    if (await db_session.execute(text(f"SELECT EXISTS (SELECT 1 FROM {DEFAULT_PARTITION})"))).scalar():
+        logger.warning("{} has rows, create partitions for their months and move them", DEFAULT_PARTITION)
+    return created
+
+
+async def archive_partition(db_session: AsyncSession, name: str, directory: str) -> str:
+    '''dump a partition to <directory>/<name>.csv.gz, then detach and drop it'''
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f"{name}.csv.gz")
+
+    connection = await db_session.connection()
+    raw_connection = await connection.get_raw_connection()
+    with gzip.open(path + ".tmp", "wb") as archive:
+        async def write(chunk: bytes):
+            archive.write(chunk)
+        await raw_connection.driver_connection.copy_from_table(name, output=write, format="csv", header=True)
+    os.replace(path + ".tmp", path)
+
+    # the table is dropped only after its archive is complete on disk
+    await db_session.execute(text(f"ALTER TABLE message DETACH PARTITION {name}"))
+    await db_session.execute(text(f"DROP TABLE {name}"))
+    await db_session.commit()
+    logger.info("archived message partition {} to {}", name, path)
+    return path
+
+
+async def archive_partitions(db_session: AsyncSession, before: date, directory: str) -> list[str]:
+    '''archive every partition which ends not later than `before`'''
+    paths = []
+    for month, name in (await list_partitions(db_session)).items():
+        if add_months(month, 1) <= before:
+            paths.append(await archive_partition(db_session, name, directory))
+    return paths
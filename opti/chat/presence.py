@@ -0,0 +1,198 @@
+import asyncio
+import time
+from collections import Counter
+from datetime import datetime, timezone
+from typing import Iterable
+from uuid import UUID
+
+from redis import Redis, ResponseError
+from sqlalchemy import text, bindparam
+from sqlalchemy.dialects.postgresql import ARRAY, UUID as PG_UUID, TIMESTAMP
+
+from opti.core import metrics
+from opti.core.config import logger, PRESENCE_HEARTBEAT_INTERVAL, PRESENCE_STALE_AFTER, PRESENCE_BATCH
+from opti.core.database import async_session_maker
+from opti.core.redis import get_redis
+
+
+# one hash slot for all keys, the scripts touch them together
+PRESENCE_CONNECTIONS = "{presence}:conn"  # user_id -> open websockets on all workers
+PRESENCE_ONLINE = "{presence}:online"  # user_id -> last heartbeat, unix time
+PRESENCE_LAST_SEEN = "{presence}:last_seen"  # user_id -> unix time of going offline, not yet written to users.online_at
+PRESENCE_FLUSHING = "{presence}:last_seen:flushing"
+PRESENCE_KEYS = [PRESENCE_CONNECTIONS, PRESENCE_ONLINE, PRESENCE_LAST_SEEN]
+
+# online_at matters only once the user is offline, it is recorded when the last connection goes away
+CONNECT_SCRIPT = """
+redis.call('HINCRBY', KEYS[1], ARGV[1], 1)
+redis.call('ZADD', KEYS[2], ARGV[2], ARGV[1])
+"""
+
+DISCONNECT_SCRIPT = """
+local count = redis.call('HINCRBY', KEYS[1], ARGV[1], -1)
+if count <= 0 then
+    redis.call('HDEL', KEYS[1], ARGV[1])
+    redis.call('ZREM', KEYS[2], ARGV[1])
+    redis.call('HSET', KEYS[3], ARGV[1], ARGV[2])
+end
+return count
+"""
+
+# users removed by stale cleanup are not brought back, their next connect registers them again
+HEARTBEAT_SCRIPT = """
+for i = 2, #ARGV do
+    if redis.call('HEXISTS', KEYS[1], ARGV[i]) == 1 then
+        redis.call('ZADD', KEYS[2], ARGV[1], ARGV[i])
+    end
+end
+"""
+
+# connections of a worker which died without closing them
+EXPIRE_SCRIPT = """
+local stale = redis.call('ZRANGEBYSCORE', KEYS[2], '-inf', ARGV[1], 'WITHSCORES', 'LIMIT', 0, ARGV[2])
+for i = 1, #stale, 2 do
+    redis.call('ZREM', KEYS[2], stale[i])
+    redis.call('HDEL', KEYS[1], stale[i])
+    redis.call('HSET', KEYS[3], stale[i], stale[i + 1])
+end
+return #stale / 2
+"""
+
+UPDATE_ONLINE_AT_QUERY = text("""
+    UPDATE users SET online_at = seen.online_at
+    FROM unnest(:ids, :online_at) AS seen(id, online_at)
+    WHERE users.id = seen.id AND (users.online_at IS NULL OR users.online_at < seen.online_at)
+""").bindparams(
+    bindparam('ids', type_=ARRAY(PG_UUID(as_uuid=True))),
+    bindparam('online_at', type_=ARRAY(TIMESTAMP())),
+)
+
+local_users = metrics.gauge("presence.local_users")
+expired = metrics.counter("presence.expired")
+
+
+class Presence:
+    '''
+    Online status shared by all workers.
+    Every worker refreshes heartbeats of its own users with one script call per PRESENCE_BATCH users,
+    a user is online while it has open connections and a heartbeat newer than PRESENCE_STALE_AFTER.
+    '''
+
+    def __init__(self, redis: Redis, interval: float):
+        self.redis = redis
+        self.interval = interval
+        self.local: Counter[str] = Counter()
+        self.connect_script = redis.register_script(CONNECT_SCRIPT)
+        self.disconnect_script = redis.register_script(DISCONNECT_SCRIPT)
+        self.heartbeat_script = redis.register_script(HEARTBEAT_SCRIPT)
+        self.task: asyncio.Task | None = None
+
+    def start(self):
+        self.task = asyncio.create_task(self.run())
+
+    async def connect(self, user_id: UUID):
+        user = str(user_id)
+        await self.connect_script(keys=PRESENCE_KEYS, args=[user, time.time()])
+        # counted only when registered, a failed connect is not kept online by heartbeats
+        self.local[user] += 1
+        local_users.set(len(self.local))
+
+    async def disconnect(self, user_id: UUID):
+        user = str(user_id)
+        self.local[user] -= 1
+        if self.local[user] <= 0:
+            del self.local[user]
+        local_users.set(len(self.local))
+        await self.disconnect_script(keys=PRESENCE_KEYS, args=[user, time.time()])
+
+    async def beat(self):
+        users = list(self.local)
+        now = time.time()
+        for i in range(0, len(users), PRESENCE_BATCH):
+            await self.heartbeat_script(keys=PRESENCE_KEYS, args=[now, *users[i:i + PRESENCE_BATCH]])
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.beat()
+            except Exception as e:
+                logger.error("presence heartbeat failed: {}", e)
+
+    async def close(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+
+async def online_users(redis: Redis, user_ids: Iterable[UUID]) -> set[UUID]:
+    user_ids = list(user_ids)
+    if not user_ids:
+        return set()
+    scores = await redis.zmscore(PRESENCE_ONLINE, [str(user_id) for user_id in user_ids])
+    alive_after = time.time() - PRESENCE_STALE_AFTER
+    return {user_id for user_id, score in zip(user_ids, scores) if score is not None and score > alive_after}
+
+
+async def expire_stale_presence(redis: Redis) -> int:
+    script = redis.register_script(EXPIRE_SCRIPT)
+    total = 0
+    while True:
+        count = await script(keys=PRESENCE_KEYS, args=[time.time() - PRESENCE_STALE_AFTER, PRESENCE_BATCH])
+        total += count
+        if count < PRESENCE_BATCH:
+            break
+    if total:
+        expired.inc(total)
+        logger.info("expired presence of {} users", total)
+    return total
+
+
+async def write_online_at(last_seen: dict[str, str]):
+    ids, online_at = [], []
+    for user_id, seen_at in last_seen.items():
+        ids.append(UUID(user_id))
+        online_at.append(datetime.fromtimestamp(float(seen_at), timezone.utc).replace(tzinfo=None))
+    async with async_session_maker() as db_session:
+        await db_session.execute(UPDATE_ONLINE_AT_QUERY, {'ids': ids, 'online_at': online_at})
+        await db_session.commit()
+
+
+async def flush_presence_():
+    '''move last seen times collected since the previous run to users.online_at'''
+    redis = get_redis()
+    await expire_stale_presence(redis)
+    # a leftover of a failed run is written first, new times wait for the next run
+    if not await redis.exists(PRESENCE_FLUSHING):
+        try:
+            await redis.rename(PRESENCE_LAST_SEEN, PRESENCE_FLUSHING)
+        except ResponseError:
+            return  # nobody was seen
+    cursor = 0
+    while True:
+        cursor, last_seen = await redis.hscan(PRESENCE_FLUSHING, cursor, count=PRESENCE_BATCH)
+        if last_seen:
+            await write_online_at(last_seen)
+        if cursor == 0:
+            break
+    await redis.delete(PRESENCE_FLUSHING)
+
+
+presence: Presence | None = None
+
+
+async def init_presence():
+    global presence
+    presence = Presence(get_redis(), PRESENCE_HEARTBEAT_INTERVAL)
+    presence.start()
+
+
+async def shutdown_presence():
+    global presence
+    if presence is not None:
+        await presence.close()
+
+
+def get_presence() -> Presence:
+    global presence
+    return presence
@@ -0,0 +1,65 @@
+from typing import Iterable
+from uuid import UUID
+
+from redis import Redis
+
+from opti.core import metrics
+from opti.core.cache import SingleFlight
+from opti.core.config import PREVIEW_CACHE_TTL
+from opti.core.redis import get_script
+
+
+# preview:{user_id} string: serialized GetPreviewReturn as read from the db.
+# Unread counters and online flags are not trusted from it, they are read fresh on every hit.
+# Invalidation bumps the generation, a preview loaded before it is not stored.
+
+STORE_SCRIPT = """
+if redis.call('GET', KEYS[2]) ~= (ARGV[1] ~= '' and ARGV[1] or false) then
+    return 0
+end
+redis.call('SET', KEYS[1], ARGV[2], 'EX', ARGV[3])
+return 1
+"""
+
+hits = metrics.counter("preview_cache.hits")
+misses = metrics.counter("preview_cache.misses")
+
+# reconnect storms of one user on this worker run a single db query
+preview_flight = SingleFlight()
+
+
+def preview_keys(user_id: UUID | str) -> list[str]:
+    key = f"preview:{{{user_id}}}"
+    return [key, f"{key}:gen"]
+
+
+async def get_cached_preview(redis: Redis, user_id: UUID) -> str | None:
+    key, _ = preview_keys(user_id)
+    payload = await redis.get(key)
+    if payload is None:
+        misses.inc()
+    else:
+        hits.inc()
+    return payload
+
+
+async def preview_generation(redis: Redis, user_id: UUID) -> str:
+    _, generation_key = preview_keys(user_id)
+    return await redis.get(generation_key) or ''
+
+
+async def store_preview(redis: Redis, user_id: UUID, generation: str, payload: str):
+    await get_script(redis, STORE_SCRIPT)(
+        keys=preview_keys(user_id),
+        args=[generation, payload, PREVIEW_CACHE_TTL],
+    )
+
+
+async def invalidate_preview(redis: Redis, user_ids: Iterable[UUID | str]):
+    pipeline = redis.pipeline(transaction=False)
+    for user_id in set(map(str, user_ids)):
+        key, generation_key = preview_keys(user_id)
+        pipeline.delete(key)
+        pipeline.incr(generation_key)
+        pipeline.expire(generation_key, PREVIEW_CACHE_TTL)
+    await pipeline.execute()
@@ -0,0 +1,101 @@
+import asyncio
+import time
+from datetime import datetime
+from uuid import UUID
+
+from sqlalchemy import select, update, text
+
+from opti.chat.models import ConversationSummary
+from opti.core import metrics
+from opti.core.config import logger, CHAT_PURGE_BATCH, CHAT_PURGE_PAUSE
+from opti.core.database import async_session_maker
+from opti.core.redis import get_redis
+from opti.core.utils import utc_now
+
+
+PURGE_LOCK = "chat_purge:lock"
+PURGE_LOCK_TTL = 300
+PURGE_PROGRESS_TTL = 24 * 3600
+
+# short transactions over the chat index, every batch holds its row locks only until its commit
+PURGE_BATCH_QUERY = text("""
+    DELETE FROM message
+    WHERE created_at <= :cleared_at AND (id, created_at) IN (
+        SELECT id, created_at FROM message
+        WHERE least(sender_id, recipient_id) = :low
+            AND greatest(sender_id, recipient_id) = :high
+            AND created_at <= :cleared_at
+        ORDER BY created_at, id
+        LIMIT :batch
+    )
+""")
+
+purged = metrics.counter("chat_purge.deleted")
+batch_seconds = metrics.histogram("chat_purge.batch_seconds")
+
+
+def purge_progress_key(low_id: UUID, high_id: UUID) -> str:
+    return f"chat_purge:{low_id}:{high_id}"
+
+
+async def purge_chat(low_id: UUID, high_id: UUID, cleared_at: datetime) -> int:
+    '''delete messages hidden by the tombstone in batches, progress is kept in redis under purge_progress_key'''
+    redis = get_redis()
+    progress_key = purge_progress_key(low_id, high_id)
+    await redis.hset(progress_key, mapping={"cleared_at": cleared_at.isoformat(), "deleted": 0, "done": 0})
+    await redis.expire(progress_key, PURGE_PROGRESS_TTL)
+
+    deleted = 0
+    while True:
+        started = time.perf_counter()
+        async with async_session_maker() as db_session:
+            result = await db_session.execute(PURGE_BATCH_QUERY, {
+                'low': low_id, 'high': high_id, 'cleared_at': cleared_at, 'batch': CHAT_PURGE_BATCH,
+            })
+            await db_session.commit()
+        batch_seconds.observe(time.perf_counter() - started)
+        deleted += result.rowcount
+        purged.inc(result.rowcount)
+        await redis.hset(progress_key, mapping={"deleted": deleted, "updated_at": utc_now().isoformat()})
+        await redis.expire(PURGE_LOCK, PURGE_LOCK_TTL)
+        if result.rowcount < CHAT_PURGE_BATCH:
+            break
+        # let autovacuum, replication and live queries keep up
+        await asyncio.sleep(CHAT_PURGE_PAUSE)
+
+    async with async_session_maker() as db_session:
+        # a chat cleared again meanwhile stays pending with its new cleared_at
+        await db_session.execute(
+            update(ConversationSummary)
+            .where(
+                ConversationSummary.user_low_id == low_id,
+                ConversationSummary.user_high_id == high_id,
+                ConversationSummary.cleared_at == cleared_at,
+            )
+            .values(purge_pending=False)
+        )
+        await db_session.commit()
+    await redis.hset(progress_key, "done", 1)
+    logger.info("purged {} messages of chat {} {}", deleted, low_id, high_id)
+    return deleted
+
+
+async def purge_cleared_chats_():
+    redis = get_redis()
+    if not await redis.set(PURGE_LOCK, 1, nx=True, ex=PURGE_LOCK_TTL):
+        return  # the previous run is still deleting
+    try:
+        async with async_session_maker() as db_session:
+            result = await db_session.execute(
+                select(
+                    ConversationSummary.user_low_id,
+                    ConversationSummary.user_high_id,
+                    ConversationSummary.cleared_at,
+                )
+                .where(ConversationSummary.purge_pending)
+            )
+            pending = result.all()
+        for low_id, high_id, cleared_at in pending:
+            await purge_chat(low_id, high_id, cleared_at)
+    finally:
+        await redis.delete(PURGE_LOCK)
@@ -0,0 +1,111 @@
+from uuid import UUID
+
+from redis import Redis
+
+from opti.chat.utils import chat_pair
+from opti.core import metrics
+from opti.core.config import RECENT_MESSAGES_SIZE, RECENT_MESSAGES_TTL
+from opti.core.redis import get_script
+
+
+# chat_recent:{low:high} list: serialized MessageInChat of the newest messages, the newest first.
+# A list shorter than RECENT_MESSAGES_SIZE holds the whole visible history of the chat.
+# The generation counter is bumped by every write, a fill which read the db before it is dropped.
+
+PUSH_SCRIPT = """
+if redis.call('LPUSHX', KEYS[1], ARGV[1]) > 0 then
+    redis.call('LTRIM', KEYS[1], 0, tonumber(ARGV[2]) - 1)
+    redis.call('EXPIRE', KEYS[1], ARGV[3])
+end
+redis.call('INCR', KEYS[2])
+redis.call('EXPIRE', KEYS[2], ARGV[3])
+"""
+
+FILL_SCRIPT = """
+if redis.call('GET', KEYS[2]) ~= (ARGV[1] ~= '' and ARGV[1] or false) or redis.call('EXISTS', KEYS[1]) == 1 then
+    return 0
+end
+for i = 3, #ARGV do
+    redis.call('RPUSH', KEYS[1], ARGV[i])
+end
+redis.call('EXPIRE', KEYS[1], ARGV[2])
+return 1
+"""
+
+# only messages received by the reader are marked, like in the db
+MARK_VIEWED_SCRIPT = """
+local read = {}
+for i = 3, #ARGV do
+    read[ARGV[i]] = true
+end
+local entries = redis.call('LRANGE', KEYS[1], 0, -1)
+for i, entry in ipairs(entries) do
+    local message = cjson.decode(entry)
+    if read[message.id] and message.recipient_id == ARGV[1] and not message.is_viewed then
+        message.is_viewed = true
+        redis.call('LSET', KEYS[1], i - 1, cjson.encode(message))
+    end
+end
+redis.call('INCR', KEYS[2])
+redis.call('EXPIRE', KEYS[2], ARGV[2])
+"""
+
+hits = metrics.counter("chat_recent.hits")
+misses = metrics.counter("chat_recent.misses")
+
+
+def recent_keys(user_id: UUID, other_user_id: UUID) -> list[str]:
+    low_id, high_id = chat_pair(user_id, other_user_id)
+    key = f"chat_recent:{{{low_id}:{high_id}}}"
+    return [key, f"{key}:gen"]
+
+
+async def get_recent(redis: Redis, user_id: UUID, other_user_id: UUID, count: int) -> list[str] | None:
+    '''up to count newest entries, None when the chat is not cached'''
+    key, _ = recent_keys(user_id, other_user_id)
+    entries = await redis.lrange(key, 0, count - 1)
+    if not entries:
+        misses.inc()
+        return None
+    hits.inc()
+    return entries
+
+
+async def recent_generation(redis: Redis, user_id: UUID, other_user_id: UUID) -> str:
+    _, generation_key = recent_keys(user_id, other_user_id)
+    return await redis.get(generation_key) or ''
+
+
+async def fill_recent(redis: Redis, user_id: UUID, other_user_id: UUID, generation: str, entries: list[str]):
+    '''entries: the newest RECENT_MESSAGES_SIZE messages read from the db after recent_generation()'''
+    if not entries:
+        return
+    await get_script(redis, FILL_SCRIPT)(
+        keys=recent_keys(user_id, other_user_id),
+        args=[generation, RECENT_MESSAGES_TTL, *entries[:RECENT_MESSAGES_SIZE]],
+    )
+
+
+async def push_recent(redis: Redis, user_id: UUID, other_user_id: UUID, entry: str):
+    '''call after the message is committed'''
+    await get_script(redis, PUSH_SCRIPT)(
+        keys=recent_keys(user_id, other_user_id),
+        args=[entry, RECENT_MESSAGES_SIZE, RECENT_MESSAGES_TTL],
+    )
+
+
+async def mark_recent_viewed(redis: Redis, user_id: UUID, other_user_id: UUID, message_ids: list[UUID]):
+    '''user_id is the reader, messages sent by it are left as they are'''
+    await get_script(redis, MARK_VIEWED_SCRIPT)(
+        keys=recent_keys(user_id, other_user_id),
+        args=[str(user_id), RECENT_MESSAGES_TTL, *(str(message_id) for message_id in message_ids)],
+    )
+
+
+async def drop_recent(redis: Redis, user_id: UUID, other_user_id: UUID):
+    key, generation_key = recent_keys(user_id, other_user_id)
+    pipeline = redis.pipeline(transaction=False)
+    pipeline.delete(key)
+    pipeline.incr(generation_key)
+    pipeline.expire(generation_key, RECENT_MESSAGES_TTL)
+    await pipeline.execute()
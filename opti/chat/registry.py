@@ -0,0 +1,63 @@
+import asyncio
+import random
+
+from opti.chat.connection import ChatConnection
+from opti.chat.schema import ClientReconnectSchema
+from opti.core import metrics
+from opti.core.config import logger
+
+
+CLOSE_SERVICE_RESTART = 1012
+
+open_connections = metrics.gauge("chat.connections")
+
+
+class ConnectionRegistry:
+    '''chat sockets open on this worker, drained before the worker exits'''
+
+    def __init__(self):
+        self.connections: set[ChatConnection] = set()
+        self.draining = False
+        self.jitter = 0.0
+
+    def __len__(self) -> int:
+        return len(self.connections)
+
+    def add(self, connection: ChatConnection):
+        self.connections.add(connection)
+        open_connections.inc()
+        if self.draining:
+            self.ask_reconnect(connection)
+
+    def discard(self, connection: ChatConnection):
+        if connection in self.connections:
+            self.connections.remove(connection)
+            open_connections.dec()
+
+    def ask_reconnect(self, connection: ChatConnection):
+        # spread reconnects so the other instances do not get every client at once
+        connection.send_model(ClientReconnectSchema(retry_after=round(random.uniform(0, self.jitter), 3)))
+
+    async def drain(self, timeout: float, jitter: float) -> int:
+        '''
+        Ask every client to reconnect within `jitter` seconds and wait up to `timeout` for them to leave.
+        Sockets still open after it are closed with 1012, returns their number.
+        '''
+        self.draining = True
+        self.jitter = min(jitter, timeout)
+        logger.info("draining {} chat connections", len(self.connections))
+        for connection in list(self.connections):
+            self.ask_reconnect(connection)
+
+        deadline = asyncio.get_running_loop().time() + timeout
+        while self.connections and asyncio.get_running_loop().time() < deadline:
+            await asyncio.sleep(0.1)
+
+        remaining = list(self.connections)
+        if remaining:
+            logger.warning("close {} chat connections after drain timeout", len(remaining))
+            await asyncio.gather(*(i.close(code=CLOSE_SERVICE_RESTART) for i in remaining))
+        return len(remaining)
+
+
+chat_connections = ConnectionRegistry()
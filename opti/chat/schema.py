@@ -1,7 +1,10 @@
 from datetime import datetime
 from enum import Enum
+from typing import Literal
 from uuid import UUID
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
+
+from opti.core.config import CHAT_PAGE_SIZE, CHAT_PAGE_SIZE_MAX
 
 
 class BaseAction(BaseModel):
@@ -19,15 +22,17 @@ class BaseAction(BaseModel):
         super().__init_subclass__(**kwargs)
 
 
-class ClientActionType(Enum):
+class ClientActionType(str, Enum):
     '''type request to client'''
     get_preview = "get_preview"
     receive_messages = "receive_messages"
     read_messages = "read_messages"
     delete_chat = "delete_chat"
+    resync = "resync"
+    reconnect = "reconnect"
 
 
-class ServerActionType(Enum):
+class ServerActionType(str, Enum):
     '''type request to server'''
     get_chat = "get_chat"
     send_message = "send_message"
@@ -53,6 +58,7 @@ class ChatPreview(BaseModel):
     user: UserInfo
     last_message: MessageInChat
     count_unread_message: int
+    online: bool = False
 
 
 class GetPreviewReturn(BaseAction):
@@ -60,24 +66,34 @@ class GetPreviewReturn(BaseAction):
     chat_list: list[ChatPreview]
 
 
+class MessageCursor(BaseModel):
+    '''position of the oldest message already sent to client'''
+    created_at: datetime
+    id: UUID
+
+
 class GetChatSchema(BaseAction):
-    action_type: ServerActionType = ServerActionType.get_chat
+    action_type: Literal[ServerActionType.get_chat] = ServerActionType.get_chat
     user_id: UUID
+    limit: int = Field(default=CHAT_PAGE_SIZE, ge=1, le=CHAT_PAGE_SIZE_MAX)
+    before: MessageCursor | None = None
 
 
 class ClientReceiveMessagesSchema(BaseAction):
     action_type: ClientActionType = ClientActionType.receive_messages
+    user_id: UUID | None = None
     messages: list[MessageInChat]
+    next_cursor: MessageCursor | None = None
 
 
 class SendMessageSchema(BaseAction):
-    action_type: ServerActionType = ServerActionType.send_message
+    action_type: Literal[ServerActionType.send_message] = ServerActionType.send_message
     recipient_id: UUID
     message: str
 
 
 class ReadMessagesSchema(BaseAction):
-    action_type: ServerActionType = ServerActionType.read_messages
+    action_type: Literal[ServerActionType.read_messages] = ServerActionType.read_messages
     other_user_id: UUID
     list_messages_id: list[UUID]
 
@@ -88,10 +104,21 @@ class ClientReadMessagesSchema(BaseAction):
 
 
 class DeleteChatScheme(BaseAction):
-    action_type: ServerActionType = ServerActionType.delete_chat
+    action_type: Literal[ServerActionType.delete_chat] = ServerActionType.delete_chat
     user_id: UUID
 
 
 class ClientDeleteChatScheme(BaseAction):
     action_type: ClientActionType = ClientActionType.delete_chat
     other_user_id: UUID
+
+
+class ClientResyncSchema(BaseAction):
+    '''some frames were dropped, client has to reload preview and open chat'''
+    action_type: ClientActionType = ClientActionType.resync
+
+
+class ClientReconnectSchema(BaseAction):
+    '''server is going down, client has to open a new socket after retry_after seconds'''
+    action_type: ClientActionType = ClientActionType.reconnect
+    retry_after: float
@@ -0,0 +1,6 @@
+from pydantic import BaseModel
+
+
+def dump(model: BaseModel) -> str:
+    '''JSON text of an outbound frame, the same string goes to websocket and redis publish'''
+    return model.model_dump_json()
@@ -1,107 +1,174 @@
 import asyncio
 import uuid
+from datetime import timedelta
 from typing import Sequence
 from uuid import UUID
-from sqlalchemy import select, or_, and_, func, desc, case, delete
+from sqlalchemy import select, or_, func, desc, case, tuple_, literal_column
 from sqlalchemy.ext.asyncio import AsyncSession
-from starlette.websockets import WebSocket
 
 from opti.auth.models import User
 from opti.auth.service import valid_user_from_db
-from opti.chat.models import Message
+from opti.chat.batcher import get_message_batcher
+from opti.chat.models import Message, ConversationSummary
 from opti.chat.schema import SendMessageSchema, ClientReceiveMessagesSchema, GetChatSchema, MessageInChat, \
     GetPreviewReturn, ChatPreview, DeleteChatScheme, UserInfo, ReadMessagesSchema, ClientReadMessagesSchema, \
-    ClientDeleteChatScheme
-from opti.chat.utils import WebsocketError
+    ClientDeleteChatScheme, MessageCursor
+from opti.chat.connection import ChatConnection
+from opti.chat.presence import get_presence, online_users
+from opti.chat.preview import get_cached_preview, preview_generation, store_preview, invalidate_preview, \
+    preview_flight
+from opti.chat.recent import get_recent, recent_generation, fill_recent, push_recent, mark_recent_viewed, \
+    drop_recent
+from opti.chat.serialization import dump
+from opti.chat.summary import summary_on_send, summary_on_clear
+from opti.chat.unread import get_unread, increment_unread, drop_unread
+from opti.chat.utils import WebsocketError, chat_pair
+from opti.core.config import READ_RECEIPT_STREAM, CHAT_RECENT_DAYS, RECENT_MESSAGES_SIZE
+from opti.core.pubsub import publish
 from opti.core.redis import get_redis
-from opti.core.utils import utc_now
+from opti.core.utils import utc_now, to_naive_utc
+
+
+async def fetch_preview(db_session: AsyncSession, user_id: UUID) -> GetPreviewReturn:
+    '''chat list as stored in the db, unread counts are the summary ones and nobody is online'''
+    other_user_id = case(
+        (ConversationSummary.user_low_id == user_id, ConversationSummary.user_high_id),
+        else_=ConversationSummary.user_low_id,
+    )
+    query = (
+        select(ConversationSummary, User.nickname)
+        .join(User, User.id == other_user_id)
+        .where(
+            or_(
+                ConversationSummary.user_low_id == user_id,
+                ConversationSummary.user_high_id == user_id,
+            ),
+            or_(
+                ConversationSummary.cleared_at.is_(None),
+                ConversationSummary.last_message_at > ConversationSummary.cleared_at,
+            ),
+        )
+        .order_by(desc(ConversationSummary.last_message_at))
+    )
+
+    result = await db_session.execute(query)
+    chat_list = []
+    for summary, nickname in result.all():
+        if summary.user_low_id == user_id:
+            other_id, unread_count = summary.user_high_id, summary.unread_low
+        else:
+            other_id, unread_count = summary.user_low_id, summary.unread_high
+        chat_list.append(ChatPreview(
+            user=UserInfo(
+                id=other_id,
+                nickname=nickname,
+            ),
+            last_message=MessageInChat(
+                id=summary.last_message_id,
+                sender_id=summary.last_sender_id,
+                recipient_id=user_id if summary.last_sender_id == other_id else other_id,
+                text=summary.last_message,
+                time=summary.last_message_at,
+                is_viewed=summary.last_message_viewed,
+            ),
+            count_unread_message=unread_count,
+        ))
+    return GetPreviewReturn(chat_list=chat_list)
+
+
+async def load_preview(db_session: AsyncSession, user_id: UUID) -> GetPreviewReturn:
+    redis = get_redis()
+    generation = await preview_generation(redis, user_id)
+    preview = await fetch_preview(db_session, user_id)
+    await store_preview(redis, user_id, generation, dump(preview))
+    return preview
 
 
 async def get_preview(
-    websocket: WebSocket,
+    connection: ChatConnection,
     db_session: AsyncSession,
     user_id: UUID,
 ):
-    unread_messages_count = (
-        select(
-            Message.sender_id,
-            Message.recipient_id,
-            func.count().label("unread_count")
-        )
-        .where(and_(
-            Message.is_viewed.is_(False),
-            Message.sender_id != user_id
-        ))
-        .group_by(Message.recipient_id, Message.sender_id)
-        .cte("unread_messages_count")
+    redis = get_redis()
+    if (cached := await get_cached_preview(redis, user_id)) is not None:
+        preview = GetPreviewReturn.model_validate_json(cached)
+    else:
+        preview = (await preview_flight.do(user_id, lambda: load_preview(db_session, user_id))).model_copy(deep=True)
+
+    summary_counts = {chat.user.id: chat.count_unread_message for chat in preview.chat_list}
+    unread, online = await asyncio.gather(
+        get_unread(redis, user_id, summary_counts),
+        online_users(redis, summary_counts),
     )
+    for chat in preview.chat_list:
+        chat.count_unread_message = unread[chat.user.id]
+        chat.online = chat.user.id in online
+    connection.send_model(preview)
 
-    latest_messages = (
-        select(
-            Message,
-            func.row_number()
-            .over(
-                partition_by=(func.least(Message.sender_id, Message.recipient_id),
-                              func.greatest(Message.sender_id, Message.recipient_id)),
-                order_by=desc(Message.created_at)
-            )
-            .label("rn"),
-            case(
-                (Message.sender_id == user_id, Message.recipient_id),
-                (Message.recipient_id == user_id, Message.sender_id)
-            ).label("other_user_id")
+
+async def fetch_chat_messages(
+    db_session: AsyncSession,
+    user_id: UUID,
+    other_user_id: UUID,
+    count: int,
+    before: MessageCursor | None = None,
+) -> list[MessageInChat]:
+    '''up to count visible messages of the chat older than the cursor, the newest first'''
+    least_id, greatest_id = chat_pair(user_id, other_user_id)
+    cleared_at = (
+        select(ConversationSummary.cleared_at)
+        .where(
+            ConversationSummary.user_low_id == least_id,
+            ConversationSummary.user_high_id == greatest_id,
         )
-        .where(or_(Message.recipient_id == user_id, Message.sender_id == user_id))
-        .cte("latest_messages")
+        .scalar_subquery()
     )
-
     query = (
-        select(
-            User.id,
-            User.nickname,
-            latest_messages.c.id,
-            latest_messages.c.sender_id,
-            latest_messages.c.recipient_id,
-            latest_messages.c.message,
-            latest_messages.c.created_at,
-            latest_messages.c.is_viewed,
-            func.coalesce(unread_messages_count.c.unread_count, 0).label("unread_count")
+        select(Message)
+        .where(
+            func.least(Message.sender_id, Message.recipient_id) == least_id,
+            func.greatest(Message.sender_id, Message.recipient_id) == greatest_id,
+            Message.created_at > func.coalesce(cleared_at, literal_column("'-infinity'::timestamp")),
         )
-        .outerjoin(latest_messages, User.id == latest_messages.c.other_user_id)
-        .outerjoin(unread_messages_count, and_(
-            user_id == unread_messages_count.c.recipient_id,
-            User.id == unread_messages_count.c.sender_id,
-        ))
-        .where(latest_messages.c.rn == 1)
-        .order_by(desc(latest_messages.c.created_at))
+        .order_by(desc(Message.created_at), desc(Message.id))
+        .limit(count)
     )
+    before_at = None
+    if before is not None:
+        before_at = to_naive_utc(before.created_at)
+        query = query.where(
+            # the plain bound lets postgres prune later partitions, the row comparison does not
+            Message.created_at <= before_at,
+            tuple_(Message.created_at, Message.id) < (before_at, before.id),
+        )
 
-    result = await db_session.execute(query)
-    chats_preview = GetPreviewReturn(
-        chat_list=(
-            ChatPreview(
-                user=UserInfo(
-                    id=i[0],
-                    nickname=i[1],
-                ),
-                last_message=MessageInChat(
-                    id=i[2],
-                    sender_id=i[3],
-                    recipient_id=i[4],
-                    text=i[5],
-                    time=i[6],
-                    is_viewed=i[7]
-                ),
-                count_unread_message=i[8]
-            )
-            for i in result.all()
+    # most pages are served by the latest partitions, older ones are scanned only when the recent window is short
+    recent_since = to_naive_utc(utc_now()) - timedelta(days=CHAT_RECENT_DAYS)
+    messages: Sequence[Message] = []
+    if before_at is None or before_at >= recent_since:
+        result = await db_session.execute(query.where(Message.created_at >= recent_since))
+        messages = result.scalars().all()
+    if len(messages) < count:
+        result = await db_session.execute(
+            query.where(Message.created_at < recent_since).limit(count - len(messages))
         )
-    )
-    await websocket.send_json(chats_preview.model_dump_json())
+        messages = [*messages, *result.scalars().all()]
+
+    return [
+        MessageInChat(
+            id=msg.id,
+            sender_id=msg.sender_id,
+            recipient_id=msg.recipient_id,
+            text=msg.message,
+            time=msg.created_at,
+            is_viewed=msg.is_viewed,
+        )
+        for msg in messages
+    ]
 
 
 async def get_chat(
-    websocket: WebSocket,
+    connection: ChatConnection,
     db_session: AsyncSession,
     user_id: UUID,
     data: GetChatSchema
@@ -109,135 +176,127 @@ async def get_chat(
     if not await valid_user_from_db(data.user_id):
         raise WebsocketError(f"invalid recipient_id: {data.user_id}")
 
-    query = (
-        select(Message)
-        .where(
-            or_(
-                and_(
-                    Message.recipient_id == data.user_id,
-                    Message.sender_id == user_id,
-                ),
-                and_(
-                    Message.sender_id == data.user_id,
-                    Message.recipient_id == user_id,
-                )
-            )
-        )
-        .order_by(Message.created_at)
-    )
-    result = await db_session.execute(query)
-    messages: Sequence[Message] = result.scalars().all()
+    redis = get_redis()
+    # the first screen of a chat is served from the recent messages list when it is big enough
+    use_recent = data.before is None and data.limit < RECENT_MESSAGES_SIZE
+    entries = await get_recent(redis, user_id, data.user_id, data.limit + 1) if use_recent else None
+    if entries is not None:
+        messages = [MessageInChat.model_validate_json(entry) for entry in entries]
+    elif use_recent:
+        generation = await recent_generation(redis, user_id, data.user_id)
+        messages = await fetch_chat_messages(db_session, user_id, data.user_id, RECENT_MESSAGES_SIZE)
+        await fill_recent(redis, user_id, data.user_id, generation, [dump(message) for message in messages])
+    else:
+        messages = await fetch_chat_messages(db_session, user_id, data.user_id, data.limit + 1, data.before)
+
+    next_cursor = None
+    if len(messages) > data.limit:
+        messages = messages[:data.limit]
+        next_cursor = MessageCursor(created_at=messages[-1].time, id=messages[-1].id)
+
     get_chat_return = ClientReceiveMessagesSchema(
         user_id=data.user_id,
-        messages=[
-            MessageInChat(
-                id=msg.id,
-                sender_id=msg.sender_id,
-                recipient_id=msg.recipient_id,
-                text=msg.message,
-                time=msg.created_at,
-                is_viewed=msg.is_viewed,
-            )
-            for msg in messages
-        ],
+        messages=messages[::-1],
+        next_cursor=next_cursor,
     )
-    await websocket.send_json(get_chat_return.model_dump_json())
+    connection.send_model(get_chat_return)
 
 
 async def send_message(
-    websocket: WebSocket,
+    connection: ChatConnection,
     db_session: AsyncSession,
     user_id: UUID,
     data: SendMessageSchema
 ):
-    redis = get_redis()
     if not await valid_user_from_db(data.recipient_id):
         raise WebsocketError(f"invalid recipient_id: {data.recipient_id}")
 
     message_id = uuid.uuid4()
-    send_message_return = ClientReceiveMessagesSchema(
-        messages=[MessageInChat(
-            id=message_id,
-            sender_id=user_id,
-            recipient_id=data.recipient_id,
-            text=data.message,
-            time=utc_now(),
-            is_viewed=False
-        )]
+    # the same time goes to the db, so cursors built from cached messages match the rows
+    created_at = utc_now()
+    message_in_chat = MessageInChat(
+        id=message_id,
+        sender_id=user_id,
+        recipient_id=data.recipient_id,
+        text=data.message,
+        time=created_at,
+        is_viewed=False
     )
+    payload = dump(ClientReceiveMessagesSchema(messages=[message_in_chat]))
     new_message = Message(
         id=message_id,
         sender_id=user_id,
         recipient_id=data.recipient_id,
         message=data.message,
+        created_at=to_naive_utc(created_at),
     )
-    db_session.add(new_message)
+    if (batcher := get_message_batcher()) is not None:
+        await batcher.submit(new_message)
+    else:
+        db_session.add(new_message)
+        await summary_on_send(db_session, [new_message])
+        await db_session.commit()
+
+    # nobody sees or counts the message before its row is durable
+    connection.send(payload)
+    redis = get_redis()
     await asyncio.gather(
-        redis.publish(
+        increment_unread(redis, data.recipient_id, user_id),
+        publish(
             channel=str(data.recipient_id),
-            message=send_message_return.model_dump_json(),
+            message=payload,
         ),
-        websocket.send_json(send_message_return.model_dump_json()),
-        db_session.commit()
+        push_recent(redis, user_id, data.recipient_id, dump(message_in_chat)),
+        invalidate_preview(redis, (user_id, data.recipient_id)),
     )
 
 
 async def read_message(
-    websocket: WebSocket,
+    connection: ChatConnection,
     _: AsyncSession,
     user_id: UUID,
     data: ReadMessagesSchema
 ):
     redis = get_redis()
-    data_to_client = ClientReadMessagesSchema(list_messages_id=data.list_messages_id)
-    if not (unsync_read_message := await redis.hget("unsync_read_message", str(user_id))):
-        unsync_read_message = ""
-    unsync_read_message += ";".join(str(i) for i in data.list_messages_id) + ";"
+    payload = dump(ClientReadMessagesSchema(list_messages_id=data.list_messages_id))
+    connection.send(payload)
     await asyncio.gather(
-        redis.hset(
-            "unsync_read_message",
-            str(user_id),
-            unsync_read_message
+        redis.xadd(
+            READ_RECEIPT_STREAM,
+            {"recipient_id": str(user_id), "ids": ";".join(str(i) for i in data.list_messages_id)},
         ),
-        redis.publish(
+        mark_recent_viewed(redis, user_id, data.other_user_id, data.list_messages_id),
+        publish(
             channel=str(data.other_user_id),
-            message=data_to_client.model_dump_json(),
+            message=payload,
         ),
-        websocket.send_json(data_to_client.model_dump_json()),
     )
 
 
 async def delete_chat(
-    websocket: WebSocket,
+    connection: ChatConnection,
     db_session: AsyncSession,
     user_id: UUID,
     data: DeleteChatScheme
 ):
-    redis = get_redis()
-    query = delete(Message).where(
-        or_(
-            and_(
-                Message.sender_id == user_id, Message.recipient_id == data.user_id
-            ),
-            and_(
-                Message.sender_id == data.user_id, Message.recipient_id == user_id
-            ),
-        )
-    )
-    await db_session.execute(query)
+    await summary_on_clear(db_session, user_id, data.user_id)
     await db_session.commit()
+    redis = get_redis()
     await asyncio.gather(
-        redis.publish(
-            channel=str(data.user_id),
-            message=ClientDeleteChatScheme(other_user_id=user_id).model_dump_json(),
-        ),
-        websocket.send_json(ClientDeleteChatScheme(other_user_id=data.user_id).model_dump_json()),
+        drop_unread(redis, user_id, data.user_id),
+        drop_recent(redis, user_id, data.user_id),
+        invalidate_preview(redis, (user_id, data.user_id)),
+    )
+    connection.send_model(ClientDeleteChatScheme(other_user_id=data.user_id))
+    await publish(
+        channel=str(data.user_id),
+        message=dump(ClientDeleteChatScheme(other_user_id=user_id)),
     )
 
 
 async def user_status_online(user_id: UUID):
-    pass
+    await get_presence().connect(user_id)
 
 
 async def user_status_offline(user_id: UUID):
-    pass
+    await get_presence().disconnect(user_id)
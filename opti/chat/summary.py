@@ -0,0 +1,182 @@
+from typing import Iterable, Sequence
+from uuid import UUID
+
+from sqlalchemy import update, func, bindparam, any_, text
+from sqlalchemy.dialects.postgresql import insert, ARRAY, UUID as PG_UUID, TIMESTAMP
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from opti.chat.models import Message, ConversationSummary
+from opti.chat.utils import chat_pair, WebsocketError
+from opti.core.utils import utc_now, to_naive_utc
+
+
+summary_table = ConversationSummary.__table__
+
+
+async def summary_on_send(db_session: AsyncSession, messages: Sequence[Message]):
+    '''messages in send order, must run in the transaction that inserts them'''
+    pairs: dict[tuple[UUID, UUID], dict] = {}
+    for message in messages:
+        low_id, high_id = chat_pair(message.sender_id, message.recipient_id)
+        row = pairs.setdefault((low_id, high_id), {
+            'user_low_id': low_id,
+            'user_high_id': high_id,
+            'last_message_viewed': False,
+            'unread_low': 0,
+            'unread_high': 0,
+        })
+        row['last_message_at'] = message.created_at or func.timezone('utc', func.now())
+        row['last_message_id'] = message.id
+        row['last_sender_id'] = message.sender_id
+        row['last_message'] = message.message
+        row['unread_high' if message.sender_id == low_id else 'unread_low'] += 1
+    if not pairs:
+        return
+
+    query = insert(summary_table).values(list(pairs.values()))
+    query = query.on_conflict_do_update(
+        index_elements=[summary_table.c.user_low_id, summary_table.c.user_high_id],
+        set_={
+            'last_message_id': query.excluded.last_message_id,
+            'last_sender_id': query.excluded.last_sender_id,
+            'last_message': query.excluded.last_message,
+            'last_message_at': query.excluded.last_message_at,
+            'last_message_viewed': False,
+            'unread_low': summary_table.c.unread_low + query.excluded.unread_low,
+            'unread_high': summary_table.c.unread_high + query.excluded.unread_high,
+        },
+    )
+    await db_session.execute(query)
+
+
+async def summary_on_read(db_session: AsyncSession, read_rows: Iterable[tuple[UUID, UUID, UUID]]):
+    '''
+    read_rows: (message_id, sender_id, recipient_id) of messages which just became viewed,
+    must run in the transaction that marks them
+    '''
+    pairs: dict[tuple[UUID, UUID], dict] = {}
+    for message_id, sender_id, recipient_id in read_rows:
+        low_id, high_id = chat_pair(sender_id, recipient_id)
+        params = pairs.setdefault((low_id, high_id), {
+            'low': low_id, 'high': high_id, 'read_low': 0, 'read_high': 0, 'ids': [],
+        })
+        params['read_low' if recipient_id == low_id else 'read_high'] += 1
+        params['ids'].append(message_id)
+    if not pairs:
+        return
+
+    query = (
+        update(summary_table)
+        .where(
+            summary_table.c.user_low_id == bindparam('low'),
+            summary_table.c.user_high_id == bindparam('high'),
+        )
+        .values(
+            unread_low=func.greatest(summary_table.c.unread_low - bindparam('read_low'), 0),
+            unread_high=func.greatest(summary_table.c.unread_high - bindparam('read_high'), 0),
+            last_message_viewed=summary_table.c.last_message_viewed | (
+                summary_table.c.last_message_id == any_(bindparam('ids', type_=ARRAY(PG_UUID(as_uuid=True))))
+            ),
+        )
+    )
+    await db_session.execute(query, list(pairs.values()))
+
+
+# tombstone of a pair whose summary row is missing, e.g. before backfill-summary has run
+CLEAR_MISSING_QUERY = text("""
+    INSERT INTO conversation_summary (
+        user_low_id, user_high_id, last_message_id, last_sender_id, last_message,
+        last_message_at, last_message_viewed, cleared_at, purge_pending
+    )
+    SELECT :low, :high, id, sender_id, message, created_at, is_viewed, :cleared_at, true
+    FROM message
+    WHERE least(sender_id, recipient_id) = :low AND greatest(sender_id, recipient_id) = :high
+    ORDER BY created_at DESC, id DESC
+    LIMIT 1
+    ON CONFLICT (user_low_id, user_high_id) DO UPDATE SET
+        cleared_at = excluded.cleared_at,
+        purge_pending = true,
+        unread_low = 0,
+        unread_high = 0
+""").bindparams(
+    bindparam('low', type_=PG_UUID(as_uuid=True)),
+    bindparam('high', type_=PG_UUID(as_uuid=True)),
+    bindparam('cleared_at', type_=TIMESTAMP()),
+)
+
+
+async def summary_on_clear(db_session: AsyncSession, user_id: UUID, other_user_id: UUID):
+    '''tombstone: hides the chat at once, messages are deleted later by purge_cleared_chats'''
+    low_id, high_id = chat_pair(user_id, other_user_id)
+    # messages get created_at from the app clock, the tombstone must use the same one
+    cleared_at = to_naive_utc(utc_now())
+    result = await db_session.execute(
+        update(ConversationSummary)
+        .where(
+            ConversationSummary.user_low_id == low_id,
+            ConversationSummary.user_high_id == high_id,
+        )
+        .values(
+            cleared_at=cleared_at,
+            purge_pending=True,
+            unread_low=0,
+            unread_high=0,
+        )
+    )
+    if result.rowcount == 0:
+        result = await db_session.execute(
+            CLEAR_MISSING_QUERY, {'low': low_id, 'high': high_id, 'cleared_at': cleared_at},
+        )
+    if result.rowcount == 0:
+        raise WebsocketError(f"no chat with {other_user_id}")
+
+
+BACKFILL_QUERY = text("""
+    WITH visible AS (
+        SELECT message.*
+        FROM message
+        LEFT JOIN conversation_summary AS summary
+            ON summary.user_low_id = least(sender_id, recipient_id)
+            AND summary.user_high_id = greatest(sender_id, recipient_id)
+        WHERE summary.cleared_at IS NULL OR message.created_at > summary.cleared_at
+    ), latest AS (
+        SELECT DISTINCT ON (least(sender_id, recipient_id), greatest(sender_id, recipient_id))
+            least(sender_id, recipient_id) AS user_low_id,
+            greatest(sender_id, recipient_id) AS user_high_id,
+            id, sender_id, message, created_at, is_viewed
+        FROM visible
+        ORDER BY least(sender_id, recipient_id), greatest(sender_id, recipient_id), created_at DESC, id DESC
+    ), unread AS (
+        SELECT
+            least(sender_id, recipient_id) AS user_low_id,
+            greatest(sender_id, recipient_id) AS user_high_id,
+            count(*) FILTER (WHERE recipient_id = least(sender_id, recipient_id)) AS unread_low,
+            count(*) FILTER (WHERE recipient_id = greatest(sender_id, recipient_id)) AS unread_high
+        FROM visible
+        WHERE NOT is_viewed
+        GROUP BY 1, 2
+    )
+    INSERT INTO conversation_summary (
+        user_low_id, user_high_id, last_message_id, last_sender_id, last_message,
+        last_message_at, last_message_viewed, unread_low, unread_high
+    )
+    SELECT
+        latest.user_low_id, latest.user_high_id, latest.id, latest.sender_id, latest.message,
+        latest.created_at, latest.is_viewed, coalesce(unread.unread_low, 0), coalesce(unread.unread_high, 0)
+    FROM latest
+    LEFT JOIN unread USING (user_low_id, user_high_id)
+    ON CONFLICT (user_low_id, user_high_id) DO UPDATE SET
+        last_message_id = excluded.last_message_id,
+        last_sender_id = excluded.last_sender_id,
+        last_message = excluded.last_message,
+        last_message_at = excluded.last_message_at,
+        last_message_viewed = excluded.last_message_viewed,
+        unread_low = excluded.unread_low,
+        unread_high = excluded.unread_high
+""")
+
+
+async def backfill_summary(db_session: AsyncSession) -> int:
+    result = await db_session.execute(BACKFILL_QUERY)
+    await db_session.commit()
+    return result.rowcount
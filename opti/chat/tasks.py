@@ -1,13 +1,28 @@
+import asyncio
+import os
+import socket
+from collections import Counter
 from uuid import UUID
 
 from celery import Celery
-import asyncio
-from sqlalchemy import update, or_, and_
+from redis import Redis, ResponseError
+from sqlalchemy import text, bindparam
+from sqlalchemy.dialects.postgresql import ARRAY, UUID as PG_UUID
 
-from opti.core.config import CELERY_BROKER, logger
+from opti.core.config import CELERY_BROKER, logger, READ_RECEIPT_STREAM, READ_RECEIPT_GROUP, READ_RECEIPT_BATCH, \
+    READ_RECEIPT_CLAIM_IDLE_MS, PRESENCE_FLUSH_INTERVAL, CHAT_PURGE_INTERVAL, UNREAD_RECONCILE_INTERVAL
 from opti.core.database import async_session_maker
-from opti.chat.models import Message
-from opti.core.redis import init_redis_pool, get_redis
+from opti.core.log import ThrottledLogger
+from opti.chat.partitions import ensure_partitions
+from opti.chat.presence import flush_presence_
+from opti.chat.preview import invalidate_preview
+from opti.chat.purge import purge_cleared_chats_
+from opti.chat.summary import summary_on_read
+from opti.chat.unread import reconcile_unread, decrement_unread
+from opti.core.redis import get_redis
+from opti.core.worker import run_async
+
+receipt_errors = ThrottledLogger(interval=1.0)
 
 celery = Celery('tasks', broker=CELERY_BROKER)
 celery.conf.timezone = 'UTC'
@@ -16,36 +31,148 @@ celery.conf.beat_schedule = {
         'task': 'opti.chat.tasks.sync_read_message',
         'schedule': 5,
     },
+    'flush_presence': {
+        'task': 'opti.chat.tasks.flush_presence',
+        'schedule': PRESENCE_FLUSH_INTERVAL,
+    },
+    'purge_cleared_chats': {
+        'task': 'opti.chat.tasks.purge_cleared_chats',
+        'schedule': CHAT_PURGE_INTERVAL,
+    },
+    'ensure_message_partitions': {
+        'task': 'opti.chat.tasks.ensure_message_partitions',
+        'schedule': 3600,
+    },
+    'reconcile_unread': {
+        'task': 'opti.chat.tasks.reconcile_unread_counters',
+        'schedule': UNREAD_RECONCILE_INTERVAL,
+    },
 }
 celery.conf.broker_connection_retry_on_startup = True
 
 
-async def sync_read_message_():
-    await init_redis_pool()
-    redis = get_redis()
+MARK_VIEWED_QUERY = text("""
+    UPDATE message SET is_viewed = true
+    FROM unnest(:ids, :recipients) AS read(id, recipient_id)
+    WHERE message.id = read.id AND message.recipient_id = read.recipient_id AND NOT message.is_viewed
+    RETURNING message.id, message.sender_id, message.recipient_id
+""").bindparams(
+    bindparam('ids', type_=ARRAY(PG_UUID(as_uuid=True))),
+    bindparam('recipients', type_=ARRAY(PG_UUID(as_uuid=True))),
+)
+
 
+def read_receipt_consumer() -> str:
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+async def ensure_read_receipt_group(redis: Redis):
+    try:
+        await redis.xgroup_create(READ_RECEIPT_STREAM, READ_RECEIPT_GROUP, id="0", mkstream=True)
+    except ResponseError as e:
+        if "BUSYGROUP" not in str(e):
+            raise
+
+
+async def move_legacy_read_messages(redis: Redis):
+    '''receipts written to the old unsync_read_message hash before the stream'''
     p = redis.pipeline()
     p.hgetall("unsync_read_message")
     p.delete("unsync_read_message")
-    result = await p.execute()
-    read_messages = result[0]
-    if not read_messages:
-        return
-
-    db_session = async_session_maker()
-    query = update(Message).values(is_viewed=True).where(
-        or_(
-            *(and_(
-                Message.id.in_(UUID(i) for i in value.strip(';').split(';')),
-                Message.recipient_id == recipient_id
-            ) for recipient_id, value in read_messages.items()
-            )
+    read_messages, _ = await p.execute()
+    for recipient_id, value in read_messages.items():
+        await redis.xadd(READ_RECEIPT_STREAM, {"recipient_id": recipient_id, "ids": value.strip(';')})
+
+
+async def apply_read_receipts(redis: Redis, entries: list):
+    ids, recipients = [], []
+    for entry_id, fields in entries:
+        try:
+            recipient_id = UUID(fields["recipient_id"])
+            for message_id in filter(None, fields["ids"].split(';')):
+                ids.append(UUID(message_id))
+                recipients.append(recipient_id)
+        except (KeyError, ValueError) as e:
+            receipt_errors.warning("skip invalid read receipt {}: {}", entry_id, e)
+
+    if ids:
+        async with async_session_maker() as db_session:
+            result = await db_session.execute(MARK_VIEWED_QUERY, {'ids': ids, 'recipients': recipients})
+            read_rows = result.all()
+            await summary_on_read(db_session, read_rows)
+            await db_session.commit()
+        # receipts may list messages already read or sent by the reader, counters drop only by marked rows
+        read_counts = Counter((recipient_id, sender_id) for _, sender_id, recipient_id in read_rows)
+        await asyncio.gather(*(
+            decrement_unread(redis, recipient_id, sender_id, count)
+            for (recipient_id, sender_id), count in read_counts.items()
         ))
-    await db_session.execute(query)
-    await db_session.commit()
+        # last_message_viewed of the summary changed only now
+        await invalidate_preview(redis, {user_id for _, *users in read_rows for user_id in users})
+
+    entry_ids = [entry_id for entry_id, _ in entries]
+    await redis.xack(READ_RECEIPT_STREAM, READ_RECEIPT_GROUP, *entry_ids)
+    await redis.xdel(READ_RECEIPT_STREAM, *entry_ids)
+
+
+async def sync_read_message_():
+    redis = get_redis()
+    await ensure_read_receipt_group(redis)
+    await move_legacy_read_messages(redis)
+
+    # entries delivered to a consumer which died before acking them
+    _, entries, *_ = await redis.xautoclaim(
+        READ_RECEIPT_STREAM, READ_RECEIPT_GROUP, read_receipt_consumer(),
+        min_idle_time=READ_RECEIPT_CLAIM_IDLE_MS, count=READ_RECEIPT_BATCH,
+    )
+    if entries:
+        await apply_read_receipts(redis, entries)
+
+    while True:
+        response = await redis.xreadgroup(
+            READ_RECEIPT_GROUP, read_receipt_consumer(), {READ_RECEIPT_STREAM: ">"}, count=READ_RECEIPT_BATCH,
+        )
+        if not response:
+            return
+        _, entries = response[0]
+        await apply_read_receipts(redis, entries)
+        if len(entries) < READ_RECEIPT_BATCH:
+            return
 
 
 @celery.task
 def sync_read_message():
-    asyncio.run(sync_read_message_())
+    run_async(sync_read_message_())
     logger.info("sync read message success")
+
+
+@celery.task
+def flush_presence():
+    run_async(flush_presence_())
+    logger.info("flush presence success")
+
+
+@celery.task
+def purge_cleared_chats():
+    run_async(purge_cleared_chats_())
+
+
+async def ensure_message_partitions_():
+    async with async_session_maker() as db_session:
+        await ensure_partitions(db_session)
+
+
+@celery.task
+def ensure_message_partitions():
+    run_async(ensure_message_partitions_())
+
+
+async def reconcile_unread_counters_():
+    # the summary is exact only after pending read receipts are applied
+    await sync_read_message_()
+    await reconcile_unread(get_redis())
+
+
+@celery.task
+def reconcile_unread_counters():
+    run_async(reconcile_unread_counters_())
@@ -0,0 +1,141 @@
+from typing import Iterable
+from uuid import UUID
+
+from redis import Redis
+from sqlalchemy import select, tuple_
+
+from opti.chat.models import ConversationSummary
+from opti.core.config import logger, UNREAD_RECONCILE_BATCH
+from opti.core.database import async_session_maker
+from opti.core.redis import get_script
+
+
+# unread:<user_id> hash: peer_id -> count of messages from peer not read by user.
+# summary rows hold the same numbers. Both drop when read receipts are synced,
+# by the messages which the sync actually marked as viewed.
+DECREMENT_SCRIPT = """
+local count = redis.call('HGET', KEYS[1], ARGV[1])
+if not count then
+    return nil
+end
+count = math.max(tonumber(count) - tonumber(ARGV[2]), 0)
+redis.call('HSET', KEYS[1], ARGV[1], count)
+return count
+"""
+
+# ARGV: (peer_id, counter read before the summary or '' when missing, summary count) triples
+RECONCILE_SCRIPT = """
+for i = 1, #ARGV, 3 do
+    if (redis.call('HGET', KEYS[1], ARGV[i]) or '') == ARGV[i + 1] then
+        redis.call('HSET', KEYS[1], ARGV[i], ARGV[i + 2])
+    end
+end
+"""
+
+
+def unread_key(user_id: UUID | str) -> str:
+    return f"unread:{user_id}"
+
+
+async def increment_unread(redis: Redis, user_id: UUID, peer_id: UUID):
+    await redis.hincrby(unread_key(user_id), str(peer_id), 1)
+
+
+async def decrement_unread(redis: Redis, user_id: UUID, peer_id: UUID, count: int):
+    '''clamped at 0, a missing counter stays missing and is seeded from the summary'''
+    await get_script(redis, DECREMENT_SCRIPT)(keys=[unread_key(user_id)], args=[str(peer_id), count])
+
+
+async def drop_unread(redis: Redis, user_id: UUID, peer_id: UUID):
+    await redis.hdel(unread_key(user_id), str(peer_id))
+    await redis.hdel(unread_key(peer_id), str(user_id))
+
+
+async def get_unread(redis: Redis, user_id: UUID, summary_counts: dict[UUID, int]) -> dict[UUID, int]:
+    '''counters of user_id for the given peers, missing ones are taken from the summary and stored'''
+    key = unread_key(user_id)
+    counts = await redis.hgetall(key)
+    result, missing = {}, {}
+    for peer_id, summary_count in summary_counts.items():
+        count = counts.get(str(peer_id))
+        if count is None:
+            result[peer_id] = missing[str(peer_id)] = summary_count
+        else:
+            result[peer_id] = int(count)
+    if missing:
+        pipeline = redis.pipeline(transaction=False)
+        for peer_id, count in missing.items():
+            pipeline.hsetnx(key, peer_id, count)
+        await pipeline.execute()
+    return result
+
+
+def summary_unread(rows: Iterable[ConversationSummary]) -> dict[str, dict[str, int]]:
+    counts: dict[str, dict[str, int]] = {}
+    for row in rows:
+        low_id, high_id = str(row.user_low_id), str(row.user_high_id)
+        counts.setdefault(unread_key(low_id), {})[high_id] = row.unread_low
+        counts.setdefault(unread_key(high_id), {})[low_id] = row.unread_high
+    return counts
+
+
+async def reconcile_unread(redis: Redis) -> int:
+    '''
+    Copy unread counts of every conversation from the summary, in batches by primary key.
+    Run it after read receipts are synced, otherwise the summary lags behind the counters.
+    Counters are read before the summary and overwritten only if unchanged since, a message sent
+    while the batch is read keeps its increment and the counter is corrected by the next run.
+    '''
+    total, after = 0, None
+    while True:
+        query = (
+            select(ConversationSummary.user_low_id, ConversationSummary.user_high_id)
+            .order_by(ConversationSummary.user_low_id, ConversationSummary.user_high_id)
+            .limit(UNREAD_RECONCILE_BATCH)
+        )
+        if after is not None:
+            query = query.where(
+                tuple_(ConversationSummary.user_low_id, ConversationSummary.user_high_id) > after
+            )
+        async with async_session_maker() as db_session:
+            pairs = (await db_session.execute(query)).all()
+        if not pairs:
+            break
+
+        fields: dict[str, list[str]] = {}
+        for low_id, high_id in pairs:
+            fields.setdefault(unread_key(low_id), []).append(str(high_id))
+            fields.setdefault(unread_key(high_id), []).append(str(low_id))
+        pipeline = redis.pipeline(transaction=False)
+        for key, peers in fields.items():
+            pipeline.hmget(key, peers)
+        snapshot = {
+            key: dict(zip(peers, values))
+            for (key, peers), values in zip(fields.items(), await pipeline.execute())
+        }
+
+        async with async_session_maker() as db_session:
+            rows = (await db_session.execute(
+                select(ConversationSummary).where(
+                    tuple_(ConversationSummary.user_low_id, ConversationSummary.user_high_id).in_([tuple(i) for i in pairs])
+                )
+            )).scalars().all()
+        script = get_script(redis, RECONCILE_SCRIPT)
+        pipeline = redis.pipeline(transaction=False)
+        for key, counts in summary_unread(rows).items():
+            args = []
+            for peer_id, count in counts.items():
+                args += [peer_id, snapshot[key].get(peer_id) or '', count]
+            await script(keys=[key], args=args, client=pipeline)
+        await pipeline.execute()
+        total += len(pairs)
+        after = tuple(pairs[-1])
+    logger.info("unread counters reconciled for {} conversations", total)
+    return total
+
+
+async def clear_unread(redis: Redis) -> int:
+    deleted = 0
+    async for key in redis.scan_iter(match=unread_key("*"), count=1000):
+        deleted += await redis.delete(key)
+    return deleted
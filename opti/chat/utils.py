@@ -1,2 +1,12 @@
+from uuid import UUID
+
+
 class WebsocketError(Exception):
     ...
+
+
+def chat_pair(first_id: UUID, second_id: UUID) -> tuple[UUID, UUID]:
+    """(least, greatest) of two users, python orders UUID the same way as postgres"""
+    if first_id < second_id:
+        return first_id, second_id
+    return second_id, first_id
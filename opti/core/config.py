@@ -2,10 +2,17 @@ from dotenv import load_dotenv
 import os
 from loguru import logger
 
+from opti.core.log import configure_logging, parse_levels
+
 if 'RELEASE' not in os.environ:
     load_dotenv()
 
-logger.add('logs/log.txt', rotation="500 KB")
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
+LOG_LEVELS = parse_levels(os.environ.get("LOG_LEVELS", ""))  # opti.chat=WARNING,opti.auth=DEBUG
+LOG_FILE = os.environ.get("LOG_FILE", "logs/log.txt")
+LOG_ROTATION = os.environ.get("LOG_ROTATION", "500 KB")
+LOG_JSON = os.environ.get("LOG_JSON", "true").lower() == "true"
+configure_logging(LOG_LEVEL, LOG_LEVELS, LOG_FILE, LOG_ROTATION, LOG_JSON)
 origins = [
     'http://localhost:5173/',
     'http://localhost:8000/',
@@ -15,14 +22,83 @@ origins = [
 GOOGLE_REDIRECT_URI = "http://localhost:8000/auth/google"
 GOOGLE_CERTS_URL = "https://www.googleapis.com/oauth2/v3/certs"
 GOOGLE_CERTS_TTL = 60
+GOOGLE_CERTS_REFRESH_AHEAD = 60
+GOOGLE_CERTS_RETRY = 10
+GOOGLE_JWKS_FILE = os.environ.get('GOOGLE_JWKS_FILE')
 GOOGLE_CLIENT_ID = os.environ.get('GOOGLE_CLIENT_ID')
+GOOGLE_USERINFO_URL = "https://www.googleapis.com/oauth2/v3/userinfo"
+HTTP_POOL_SIZE = int(os.environ.get("HTTP_POOL_SIZE", 100))
+HTTP_POOL_SIZE_PER_HOST = int(os.environ.get("HTTP_POOL_SIZE_PER_HOST", 20))
+HTTP_KEEPALIVE = float(os.environ.get("HTTP_KEEPALIVE", 30))
+HTTP_DNS_CACHE_TTL = int(os.environ.get("HTTP_DNS_CACHE_TTL", 300))
+HTTP_TIMEOUT = float(os.environ.get("HTTP_TIMEOUT", 10))
+HTTP_CONNECT_TIMEOUT = float(os.environ.get("HTTP_CONNECT_TIMEOUT", 3))
 SECRET_KEY = os.environ.get('SECRET_KEY')
 DB_HOST = os.environ.get("POSTGRESQL_HOST")
 DB_PORT = os.environ.get("POSTGRESQL_PORT", 5432)
 DB_NAME = os.environ.get("POSTGRESQL_NAME", "opti")
 DB_USER = os.environ.get("POSTGRESQL_USER", "postgres") 
 DB_PASS = os.environ.get("POSTGRESQL_PASS")
+DB_POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", 10))
+DB_MAX_OVERFLOW = int(os.environ.get("DB_MAX_OVERFLOW", 20))
+DB_POOL_TIMEOUT = float(os.environ.get("DB_POOL_TIMEOUT", 10))
+DB_POOL_RECYCLE = int(os.environ.get("DB_POOL_RECYCLE", 60 * 30))
+DB_POOL_PRE_PING = os.environ.get("DB_POOL_PRE_PING", "true").lower() == "true"
+DB_STATEMENT_CACHE_SIZE = int(os.environ.get("DB_STATEMENT_CACHE_SIZE", 500))
 API_ACCESS_TOKEN_EXPIRE_MINUTES = 60 * 24 * 30
+TOKEN_CACHE_SIZE = int(os.environ.get("TOKEN_CACHE_SIZE", 100_000))
+VALID_USER_CACHE_SIZE = int(os.environ.get("VALID_USER_CACHE_SIZE", 100_000))
+VALID_USER_CACHE_TTL = int(os.environ.get("VALID_USER_CACHE_TTL", 60))
+# bounds how long a block made outside of block_user (plain sql) is ignored
+VALID_USER_REDIS_TTL = int(os.environ.get("VALID_USER_REDIS_TTL", 3600))
+USER_INVALIDATION_CHANNEL = "user_invalidation"
 REDIS_URL = os.environ.get("REDIS_URL", "redis://localhost:6379")
 REDIS_DB = os.environ.get("REDIS_DB", 0)
+REDIS_CLUSTER = os.environ.get("REDIS_CLUSTER", "false").lower() == "true"
+PUBSUB_CONNECTIONS = int(os.environ.get("PUBSUB_CONNECTIONS", 1))
+# kombu can't use a cluster, point it at a standalone redis when REDIS_CLUSTER is on
 CELERY_BROKER = os.environ.get("CELERY_BROKER", REDIS_URL)
+MESSAGE_BATCH_ENABLED = os.environ.get("MESSAGE_BATCH_ENABLED", "false").lower() == "true"
+MESSAGE_BATCH_MAX_ROWS = int(os.environ.get("MESSAGE_BATCH_MAX_ROWS", 500))
+MESSAGE_BATCH_MAX_DELAY = int(os.environ.get("MESSAGE_BATCH_MAX_DELAY_MS", 5)) / 1000
+READ_RECEIPT_STREAM = "read_receipts"
+READ_RECEIPT_GROUP = "read_receipts_sync"
+READ_RECEIPT_BATCH = int(os.environ.get("READ_RECEIPT_BATCH", 1000))
+READ_RECEIPT_CLAIM_IDLE_MS = int(os.environ.get("READ_RECEIPT_CLAIM_IDLE_MS", 60_000))
+SEARCH_MIN_LENGTH = 2
+SEARCH_MAX_LENGTH = 64
+SEARCH_PAGE_SIZE = 20
+SEARCH_PAGE_SIZE_MAX = 50
+SEARCH_CACHE_SIZE = int(os.environ.get("SEARCH_CACHE_SIZE", 10_000))
+SEARCH_CACHE_TTL = int(os.environ.get("SEARCH_CACHE_TTL", 10))
+OUTBOX_SIZE = int(os.environ.get("OUTBOX_SIZE", 256))
+OUTBOX_POLICY = os.environ.get("OUTBOX_POLICY", "coalesce")
+CHAT_PAGE_SIZE = 50
+CHAT_PAGE_SIZE_MAX = 200
+
+PRESENCE_HEARTBEAT_INTERVAL = float(os.environ.get("PRESENCE_HEARTBEAT_INTERVAL", 30))
+PRESENCE_STALE_AFTER = float(os.environ.get("PRESENCE_STALE_AFTER", 90))
+PRESENCE_FLUSH_INTERVAL = float(os.environ.get("PRESENCE_FLUSH_INTERVAL", 60))
+PRESENCE_BATCH = int(os.environ.get("PRESENCE_BATCH", 5000))
+
+CHAT_PURGE_BATCH = int(os.environ.get("CHAT_PURGE_BATCH", 1000))
+CHAT_PURGE_PAUSE = float(os.environ.get("CHAT_PURGE_PAUSE", 0.05))
+CHAT_PURGE_INTERVAL = float(os.environ.get("CHAT_PURGE_INTERVAL", 10))
+
+MESSAGE_PARTITIONS_AHEAD = int(os.environ.get("MESSAGE_PARTITIONS_AHEAD", 2))
+MESSAGE_RETENTION_MONTHS = int(os.environ.get("MESSAGE_RETENTION_MONTHS", 24))
+MESSAGE_ARCHIVE_DIR = os.environ.get("MESSAGE_ARCHIVE_DIR", "archive")
+CHAT_RECENT_DAYS = int(os.environ.get("CHAT_RECENT_DAYS", 31))
+
+UNREAD_RECONCILE_INTERVAL = float(os.environ.get("UNREAD_RECONCILE_INTERVAL", 600))
+UNREAD_RECONCILE_BATCH = int(os.environ.get("UNREAD_RECONCILE_BATCH", 1000))
+
+RECENT_MESSAGES_SIZE = int(os.environ.get("RECENT_MESSAGES_SIZE", 100))
+RECENT_MESSAGES_TTL = int(os.environ.get("RECENT_MESSAGES_TTL", 24 * 3600))
+PREVIEW_CACHE_TTL = int(os.environ.get("PREVIEW_CACHE_TTL", 300))
+
+SERVE_HOST = os.environ.get("SERVE_HOST", "0.0.0.0")
+SERVE_PORT = int(os.environ.get("SERVE_PORT", 8000))
+SERVE_WORKERS = int(os.environ.get("SERVE_WORKERS", os.cpu_count() or 1))
+SHUTDOWN_DRAIN_TIMEOUT = float(os.environ.get("SHUTDOWN_DRAIN_TIMEOUT", 20))
+RECONNECT_JITTER = float(os.environ.get("RECONNECT_JITTER", 10))
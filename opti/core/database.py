@@ -1,10 +1,11 @@
+import asyncio
 from typing import AsyncGenerator
 
 from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
 from sqlalchemy.orm import sessionmaker, DeclarativeBase
-from sqlalchemy.pool import NullPool
 
-from opti.core.config import DB_HOST, DB_NAME, DB_PASS, DB_PORT, DB_USER
+from opti.core.config import DB_HOST, DB_NAME, DB_PASS, DB_PORT, DB_USER, DB_POOL_SIZE, DB_MAX_OVERFLOW, \
+    DB_POOL_TIMEOUT, DB_POOL_RECYCLE, DB_POOL_PRE_PING, DB_STATEMENT_CACHE_SIZE
 
 
 DATABASE_URL = f"postgresql+asyncpg://{DB_USER}:{DB_PASS}@{DB_HOST}:{DB_PORT}/{DB_NAME}"
@@ -18,10 +19,44 @@ class DBase(DeclarativeBase):
         return f"<{self.__class__.__name__} ({', '.join(cols)})>"
 
 
-engine = create_async_engine(DATABASE_URL, poolclass=NullPool)
+engine = create_async_engine(
+    DATABASE_URL,
+    pool_size=DB_POOL_SIZE,
+    max_overflow=DB_MAX_OVERFLOW,
+    pool_timeout=DB_POOL_TIMEOUT,
+    pool_recycle=DB_POOL_RECYCLE,
+    pool_pre_ping=DB_POOL_PRE_PING,
+    connect_args={"prepared_statement_cache_size": DB_STATEMENT_CACHE_SIZE},
+)
 async_session_maker = sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
 
 
 async def get_async_session() -> AsyncGenerator[AsyncSession, None]:
     async with async_session_maker() as session:
         yield session
+
+
+def get_pool_stats() -> dict:
+    pool = engine.pool
+    return {
+        "size": pool.size(),
+        "checked_in": pool.checkedin(),
+        "checked_out": pool.checkedout(),
+        "overflow": pool.overflow(),
+        "max_overflow": DB_MAX_OVERFLOW,
+        "timeout": DB_POOL_TIMEOUT,
+    }
+
+
+async def warm_up_engine(size: int = DB_POOL_SIZE):
+    '''open `size` pool connections at once, so the first requests do not pay for connecting'''
+    connections = [engine.connect() for _ in range(size)]
+    results = await asyncio.gather(*(connection.start() for connection in connections), return_exceptions=True)
+    await asyncio.gather(*(connection.close() for connection in connections if connection.sync_connection is not None))
+    for result in results:
+        if isinstance(result, BaseException):
+            raise result
+
+
+async def shutdown_engine():
+    await engine.dispose()
@@ -0,0 +1,51 @@
+import time
+from types import SimpleNamespace
+
+import aiohttp
+
+from opti.core import metrics
+from opti.core.config import HTTP_POOL_SIZE, HTTP_POOL_SIZE_PER_HOST, HTTP_KEEPALIVE, HTTP_DNS_CACHE_TTL, \
+    HTTP_TIMEOUT, HTTP_CONNECT_TIMEOUT
+
+
+http_client: aiohttp.ClientSession = None
+
+
+async def _on_request_start(_: aiohttp.ClientSession, context: SimpleNamespace, __):
+    context.started = time.perf_counter()
+
+
+async def _on_request_end(_: aiohttp.ClientSession, context: SimpleNamespace, params: aiohttp.TraceRequestEndParams):
+    metrics.histogram(f"http.{params.url.host}.seconds").observe(time.perf_counter() - context.started)
+
+
+async def _on_request_exception(_: aiohttp.ClientSession, __, params: aiohttp.TraceRequestExceptionParams):
+    metrics.counter(f"http.{params.url.host}.errors").inc()
+
+
+async def init_http_client():
+    global http_client
+    trace = aiohttp.TraceConfig()
+    trace.on_request_start.append(_on_request_start)
+    trace.on_request_end.append(_on_request_end)
+    trace.on_request_exception.append(_on_request_exception)
+    http_client = aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(
+            limit=HTTP_POOL_SIZE,
+            limit_per_host=HTTP_POOL_SIZE_PER_HOST,
+            keepalive_timeout=HTTP_KEEPALIVE,
+            ttl_dns_cache=HTTP_DNS_CACHE_TTL,
+        ),
+        timeout=aiohttp.ClientTimeout(total=HTTP_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT),
+        trace_configs=[trace],
+    )
+
+
+async def shutdown_http_client():
+    global http_client
+    await http_client.close()
+
+
+def get_http_client() -> aiohttp.ClientSession:
+    global http_client
+    return http_client
@@ -0,0 +1,63 @@
+import random
+import sys
+import time
+
+from loguru import logger
+
+
+def parse_levels(value: str) -> dict[str, str]:
+    '''"opti.chat=WARNING,opti.auth=DEBUG" -> {"opti.chat": "WARNING", "opti.auth": "DEBUG"}'''
+    levels = {}
+    for item in filter(None, (i.strip() for i in value.split(','))):
+        name, _, level = item.partition('=')
+        levels[name.strip()] = level.strip().upper()
+    return levels
+
+
+def configure_logging(level: str, levels: dict[str, str], path: str, rotation: str, serialize: bool):
+    '''
+    Sinks write from a background thread (enqueue=True), the event loop only puts records to a queue.
+    Per module levels are a loguru filter, records below them are dropped before formatting.
+    '''
+    filter_ = {"": level, **levels}
+    logger.remove()
+    logger.add(sys.stderr, level="DEBUG", filter=filter_, enqueue=True)
+    logger.add(path, level="DEBUG", filter=filter_, rotation=rotation, serialize=serialize, enqueue=True)
+
+
+class ThrottledLogger:
+    '''
+    For events which happen per message: every record is kept with probability `sample`,
+    then at most one record per `interval` seconds is written for every message template.
+    The number of skipped records is bound to the next written one as `suppressed`.
+    '''
+
+    def __init__(self, interval: float | None = None, sample: float = 1.0):
+        self.interval = interval
+        self.sample = sample
+        self.last: dict[str, float] = {}
+        self.suppressed: dict[str, int] = {}
+
+    def log(self, level: str, message: str, *args, **kwargs):
+        if self.sample < 1.0 and random.random() >= self.sample:
+            return
+        if self.interval is not None:
+            now = time.monotonic()
+            if now - self.last.get(message, -self.interval) < self.interval:
+                self.suppressed[message] = self.suppressed.get(message, 0) + 1
+                return
+            self.last[message] = now
+        suppressed = self.suppressed.pop(message, 0)
+        logger.opt(depth=2).bind(suppressed=suppressed).log(level, message, *args, **kwargs)
+
+    def debug(self, message: str, *args, **kwargs):
+        self.log("DEBUG", message, *args, **kwargs)
+
+    def info(self, message: str, *args, **kwargs):
+        self.log("INFO", message, *args, **kwargs)
+
+    def warning(self, message: str, *args, **kwargs):
+        self.log("WARNING", message, *args, **kwargs)
+
+    def error(self, message: str, *args, **kwargs):
+        self.log("ERROR", message, *args, **kwargs)
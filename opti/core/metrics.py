@@ -0,0 +1,83 @@
+from bisect import bisect_left
+
+
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class Counter:
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount: int = 1):
+        self.value += amount
+
+    def snapshot(self):
+        return self.value
+
+
+class Gauge:
+    def __init__(self):
+        self.value = 0
+
+    def set(self, value: float):
+        self.value = value
+
+    def inc(self, amount: float = 1):
+        self.value += amount
+
+    def dec(self, amount: float = 1):
+        self.value -= amount
+
+    def snapshot(self):
+        return self.value
+
+
+class Histogram:
+    def __init__(self, buckets: tuple = DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0
+        self.max = 0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def snapshot(self):
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "avg": self.sum / self.count if self.count else 0,
+            "max": self.max,
+            "buckets": dict(zip((*map(str, self.buckets), "inf"), self.counts)),
+        }
+
+
+_metrics: dict[str, Counter | Gauge | Histogram] = {}
+
+
+def _get_or_create(name: str, factory):
+    metric = _metrics.get(name)
+    if metric is None:
+        metric = _metrics[name] = factory()
+    return metric
+
+
+def counter(name: str) -> Counter:
+    return _get_or_create(name, Counter)
+
+
+def gauge(name: str) -> Gauge:
+    return _get_or_create(name, Gauge)
+
+
+def histogram(name: str, buckets: tuple = DEFAULT_BUCKETS) -> Histogram:
+    return _get_or_create(name, lambda: Histogram(buckets))
+
+
+def snapshot() -> dict:
+    return {name: metric.snapshot() for name, metric in sorted(_metrics.items())}
@@ -0,0 +1,250 @@
+import asyncio
+import zlib
+from typing import Awaitable, Callable
+
+from redis import Redis
+from redis.asyncio import ConnectionPool
+from redis.asyncio.client import PubSub
+from redis.asyncio.cluster import RedisCluster, ClusterNode
+
+from opti.core.config import logger, PUBSUB_CONNECTIONS
+from opti.core.log import ThrottledLogger
+from opti.core.redis import get_redis
+
+
+Sink = Callable[[str], None]
+
+MESSAGE_TYPES = ("message", "smessage")
+
+pubsub_errors = ThrottledLogger(interval=1.0)
+
+
+class ShardMovedError(Exception):
+    '''the node dropped a sharded subscription because the channel slot moved to another node'''
+
+
+class ShardedPubSub(PubSub):
+    '''
+    SSUBSCRIBE / SUNSUBSCRIBE on a single cluster node, redis-py 4.6 knows only classic channels.
+    Subscriptions are restored by on_connect after a reconnect, like the classic ones.
+    '''
+
+    PUBLISH_MESSAGE_TYPES = ("message", "pmessage", "smessage")
+    UNSUBSCRIBE_MESSAGE_TYPES = ("unsubscribe", "punsubscribe", "sunsubscribe")
+
+    async def on_connect(self, connection):
+        self.pending_unsubscribe_channels.clear()
+        if self.channels:
+            await self.subscribe(*(self.encoder.decode(channel, force=True) for channel in self.channels))
+
+    async def subscribe(self, *channels: str):
+        result = await self.execute_command("SSUBSCRIBE", *channels)
+        new_channels = self._normalize_keys(dict.fromkeys(channels))
+        self.channels.update(new_channels)
+        self.pending_unsubscribe_channels.difference_update(new_channels)
+        return result
+
+    def unsubscribe(self, *channels: str) -> Awaitable:
+        self.pending_unsubscribe_channels.update(self._normalize_keys(dict.fromkeys(channels)))
+        return self.execute_command("SUNSUBSCRIBE", *channels)
+
+    async def handle_message(self, response, ignore_subscribe_messages=False):
+        if response[0] in ("sunsubscribe", b"sunsubscribe") and response[1] not in self.pending_unsubscribe_channels:
+            raise ShardMovedError(response[1])
+        return await super().handle_message(response, ignore_subscribe_messages)
+
+
+class _PubSubConnection:
+    '''one redis pubsub connection shared by every local subscriber of its channels'''
+
+    def __init__(self, pubsub: PubSub, on_error: Callable[["_PubSubConnection"], Awaitable] | None = None):
+        self.pubsub = pubsub
+        self.on_error = on_error
+        self.sinks: dict[str, set[Sink]] = {}
+        self.lock = asyncio.Lock()
+        self.reader: asyncio.Task | None = None
+
+    async def subscribe(self, channel: str, sink: Sink):
+        async with self.lock:
+            sinks = self.sinks.setdefault(channel, set())
+            sinks.add(sink)
+            if len(sinks) == 1:
+                try:
+                    await self.pubsub.subscribe(channel)
+                except Exception:
+                    del self.sinks[channel]
+                    raise
+            if self.reader is None:
+                self.reader = asyncio.create_task(self.read())
+
+    async def unsubscribe(self, channel: str, sink: Sink):
+        async with self.lock:
+            sinks = self.sinks.get(channel)
+            if sinks is None:
+                return
+            sinks.discard(sink)
+            if not sinks:
+                del self.sinks[channel]
+                await self.pubsub.unsubscribe(channel)
+
+    async def read(self):
+        while True:
+            try:
+                message = await self.pubsub.get_message(ignore_subscribe_messages=True, timeout=1.0)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                pubsub_errors.error("pubsub read error: {}", e)
+                await asyncio.sleep(1)
+                if self.on_error is not None:
+                    await self.on_error(self)
+                continue
+            if message is None or message["type"] not in MESSAGE_TYPES:
+                continue
+            self.dispatch(message["channel"], message["data"])
+
+    def dispatch(self, channel: str, data: str):
+        for sink in tuple(self.sinks.get(channel, ())):
+            try:
+                sink(data)
+            except Exception as e:
+                pubsub_errors.error("pubsub sink error on {}: {}", channel, e)
+
+    async def close(self):
+        if self.reader is not None:
+            self.reader.cancel()
+            try:
+                await self.reader
+            except asyncio.CancelledError:
+                pass
+        await self.pubsub.close()
+
+
+class PubSubMultiplexer:
+    '''
+    Fan-out of redis channels to local subscribers over a few shared connections.
+    Channels are refcounted: SUBSCRIBE on the first local sink, UNSUBSCRIBE after the last one.
+    '''
+
+    def __init__(self, redis: Redis, connections: int = 1):
+        self.connections = [_PubSubConnection(redis.pubsub()) for _ in range(max(connections, 1))]
+
+    def _connection(self, channel: str) -> _PubSubConnection:
+        return self.connections[zlib.crc32(channel.encode()) % len(self.connections)]
+
+    async def subscribe(self, channel: str, sink: Sink):
+        await self._connection(channel).subscribe(channel, sink)
+
+    async def unsubscribe(self, channel: str, sink: Sink):
+        await self._connection(channel).unsubscribe(channel, sink)
+
+    def stats(self) -> dict:
+        return {
+            "channels": sum(len(i.sinks) for i in self.connections),
+            "subscribers": sum(len(sinks) for i in self.connections for sinks in i.sinks.values()),
+        }
+
+    async def close(self):
+        for connection in self.connections:
+            await connection.close()
+
+
+class ShardedPubSubMultiplexer(PubSubMultiplexer):
+    '''
+    Redis Cluster variant: sharded channels are served only by the node owning the channel slot,
+    so there is one ShardedPubSub connection per node which owns some of our channels.
+    '''
+
+    def __init__(self, redis: RedisCluster):
+        self.redis = redis
+        self.nodes: dict[str, _PubSubConnection] = {}
+        self.routes: dict[str, _PubSubConnection] = {}
+        # closes of emptied node connections, the loop keeps only weak references to tasks
+        self.closing: set[asyncio.Task] = set()
+
+    @property
+    def connections(self) -> list[_PubSubConnection]:
+        return list(self.nodes.values())
+
+    def _node_connection(self, node: ClusterNode) -> _PubSubConnection:
+        connection = self.nodes.get(node.name)
+        if connection is None:
+            pool = ConnectionPool(connection_class=node.connection_class, **node.connection_kwargs)
+            connection = _PubSubConnection(ShardedPubSub(pool), on_error=self.reroute)
+            self.nodes[node.name] = connection
+        return connection
+
+    def _connection(self, channel: str) -> _PubSubConnection:
+        connection = self.routes.get(channel)
+        if connection is None:
+            connection = self._node_connection(self.redis.get_node_from_key(channel))
+            self.routes[channel] = connection
+        return connection
+
+    async def unsubscribe(self, channel: str, sink: Sink):
+        connection = self.routes.get(channel)
+        if connection is None:
+            return
+        await connection.unsubscribe(channel, sink)
+        if channel not in connection.sinks:
+            del self.routes[channel]
+
+    async def reroute(self, connection: _PubSubConnection):
+        '''after a failover or resharding channels of a node can belong to another node'''
+        try:
+            await self.redis.nodes_manager.initialize()
+        except Exception as e:
+            logger.error("cluster slots refresh failed: {}", e)
+            return
+        async with connection.lock:
+            moved = {}
+            for channel in list(connection.sinks):
+                if self._node_connection(self.redis.get_node_from_key(channel)) is not connection:
+                    moved[channel] = connection.sinks.pop(channel)
+                    # forget locally, the old node is gone or has already dropped it
+                    connection.pubsub.channels.pop(channel, None)
+                    del self.routes[channel]
+        for channel, sinks in moved.items():
+            for sink in sinks:
+                await self.subscribe(channel, sink)
+        if moved:
+            logger.info("moved {} sharded channels to other nodes", len(moved))
+        if not connection.sinks:
+            for name, node_connection in list(self.nodes.items()):
+                if node_connection is connection:
+                    del self.nodes[name]
+            task = asyncio.create_task(connection.close())
+            self.closing.add(task)
+            task.add_done_callback(self.closing.discard)
+
+
+async def publish(channel: str, message: str) -> int:
+    '''in cluster mode SPUBLISH reaches only the node owning the channel, PUBLISH is broadcast to every node'''
+    redis = get_redis()
+    if isinstance(redis, RedisCluster):
+        return await redis.execute_command(
+            "SPUBLISH", channel, message, target_nodes=redis.get_node_from_key(channel),
+        )
+    return await redis.publish(channel, message)
+
+
+pubsub: PubSubMultiplexer = None
+
+
+async def init_pubsub():
+    global pubsub
+    redis = get_redis()
+    if isinstance(redis, RedisCluster):
+        pubsub = ShardedPubSubMultiplexer(redis)
+    else:
+        pubsub = PubSubMultiplexer(redis, PUBSUB_CONNECTIONS)
+
+
+async def shutdown_pubsub():
+    global pubsub
+    await pubsub.close()
+
+
+def get_pubsub() -> PubSubMultiplexer:
+    global pubsub
+    return pubsub
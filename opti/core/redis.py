@@ -1,12 +1,26 @@
+from weakref import WeakKeyDictionary
+
 from redis import asyncio as aioredis, Redis
-from opti.core.config import REDIS_URL, REDIS_DB
+from redis.commands.core import AsyncScript
+from redis.asyncio.cluster import RedisCluster
+from opti.core.config import REDIS_URL, REDIS_DB, REDIS_CLUSTER
 
 
-redis: Redis = None
+redis: Redis | RedisCluster = None
+_scripts: WeakKeyDictionary[Redis | RedisCluster, dict[str, AsyncScript]] = WeakKeyDictionary()
 
 
 async def init_redis_pool():
     global redis
+    if REDIS_CLUSTER:
+        # cluster nodes have the only db 0, REDIS_URL is any node of the cluster
+        redis = RedisCluster.from_url(
+            REDIS_URL,
+            encoding="utf-8",
+            decode_responses=True,
+        )
+        await redis.initialize()
+        return
     redis = await aioredis.from_url(
         REDIS_URL,
         encoding="utf-8",
@@ -20,6 +34,14 @@ async def shutdown_redis_pool():
     await redis.close()
 
 
-def get_redis() -> Redis:
+def get_redis() -> Redis | RedisCluster:
     global redis
-    return redis
\ No newline at end of file
+    return redis
+
+
+def get_script(client: Redis | RedisCluster, source: str) -> AsyncScript:
+    '''lua script registered once per client, register_script hashes the source on every call'''
+    scripts = _scripts.setdefault(client, {})
+    if (script := scripts.get(source)) is None:
+        script = scripts[source] = client.register_script(source)
+    return script
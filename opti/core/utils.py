@@ -5,6 +5,13 @@ from datetime import datetime, timezone
 utc_now = partial(datetime.now, timezone.utc)
 
 
+def to_naive_utc(dt: datetime) -> datetime:
+    """timestamps are stored as utc without tz"""
+    if dt.tzinfo is None:
+        return dt
+    return dt.astimezone(timezone.utc).replace(tzinfo=None)
+
+
 def create_nickname_from_email(email: str) -> str:
     default_nickname = email.strip('@')[0]
     return default_nickname
@@ -0,0 +1,55 @@
+import asyncio
+from typing import Awaitable, TypeVar
+
+from celery.signals import worker_process_init, worker_process_shutdown, worker_shutdown
+
+from opti.core.config import logger
+from opti.core.database import engine, shutdown_engine
+from opti.core.redis import init_redis_pool, shutdown_redis_pool
+
+
+T = TypeVar('T')
+
+loop: asyncio.AbstractEventLoop | None = None
+
+
+async def _startup():
+    await init_redis_pool()
+    # the engine could be created in the parent process before fork, its connections are not ours
+    await engine.dispose(close=False)
+
+
+async def _shutdown():
+    await shutdown_redis_pool()
+    await shutdown_engine()
+
+
+@worker_process_init.connect
+def init_worker_runtime(**_):
+    '''one event loop with redis and db pools for the whole life of a worker process'''
+    global loop
+    if loop is not None:
+        return
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    loop.run_until_complete(_startup())
+    logger.debug("worker runtime is up")
+
+
+@worker_process_shutdown.connect
+@worker_shutdown.connect
+def shutdown_worker_runtime(**_):
+    global loop
+    if loop is None:
+        return
+    loop.run_until_complete(_shutdown())
+    loop.close()
+    loop = None
+    logger.debug("worker runtime is down")
+    logger.complete()
+
+
+def run_async(coro: Awaitable[T]) -> T:
+    '''run coroutine on the worker loop, the loop is started lazily for solo pool and eager tasks'''
+    init_worker_runtime()
+    return loop.run_until_complete(coro)
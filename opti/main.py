@@ -3,19 +3,43 @@ from starlette.middleware.cors import CORSMiddleware
 from contextlib import asynccontextmanager
 
 from opti.auth.api import auth
+from opti.auth.jwt import google_key_store
+from opti.auth.service import subscribe_user_invalidation
 from opti.user_api.user_api import user_api
 from opti.chat.api import chat
+from opti.chat.batcher import init_message_batcher, shutdown_message_batcher
+from opti.chat.presence import init_presence, shutdown_presence
 from opti.core.config import logger, origins
-from opti.core.redis import init_redis_pool, shutdown_redis_pool
+from opti.core import metrics
+from opti.core.database import get_pool_stats, shutdown_engine, warm_up_engine
+from opti.core.http import init_http_client, shutdown_http_client
+from opti.core.pubsub import init_pubsub, shutdown_pubsub
+from opti.core.redis import init_redis_pool, shutdown_redis_pool, get_redis
 
 
 @asynccontextmanager
 async def lifespan(_: FastAPI):
     await init_redis_pool()
+    await init_pubsub()
+    await subscribe_user_invalidation()
+    await init_http_client()
+    await google_key_store.start()
+    await init_message_batcher()
+    await init_presence()
+    # the server starts accepting only after startup, pools are filled before the first request
+    await warm_up_engine()
+    await get_redis().ping()
     logger.info("Opti is up")
     yield
+    await shutdown_presence()
+    await shutdown_message_batcher()
+    await google_key_store.close()
+    await shutdown_http_client()
+    await shutdown_pubsub()
     await shutdown_redis_pool()
+    await shutdown_engine()
     logger.info("Opti is down")
+    await logger.complete()
 
 
 app = FastAPI(lifespan=lifespan)
@@ -36,6 +60,16 @@ async def is_run():
     return 'app is run'
 
 
+@main_router.get('/health')
+async def health():
+    return {"db_pool": get_pool_stats()}
+
+
+@main_router.get('/metrics')
+async def get_metrics():
+    return metrics.snapshot()
+
+
 main_router.include_router(auth)
 main_router.include_router(user_api)
 main_router.include_router(chat)
@@ -44,4 +78,4 @@ app.include_router(main_router)
 
 @app.exception_handler(Exception)
 async def exception_handler(_: Request, exc: Exception):
-    logger.error(f"Unhandled exception: {exc}")
+    logger.error("Unhandled exception: {}", exc)
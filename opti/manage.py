@@ -0,0 +1,75 @@
+import argparse
+import asyncio
+from datetime import date
+
+from opti.core.config import logger, MESSAGE_RETENTION_MONTHS, MESSAGE_ARCHIVE_DIR
+from opti.core.database import async_session_maker, shutdown_engine
+from opti.core.utils import utc_now
+from opti.chat.partitions import ensure_partitions, archive_partitions, add_months, month_start
+from opti.chat.summary import backfill_summary
+from opti.chat.unread import clear_unread, reconcile_unread
+from opti.core.redis import init_redis_pool, get_redis, shutdown_redis_pool
+
+
+async def backfill_summary_command(_: argparse.Namespace):
+    async with async_session_maker() as session:
+        count = await backfill_summary(session)
+    logger.info("conversation summary backfilled: {} chats", count)
+
+
+async def ensure_partitions_command(_: argparse.Namespace):
+    async with async_session_maker() as session:
+        await ensure_partitions(session)
+
+
+async def archive_partitions_command(args: argparse.Namespace):
+    before = args.before or add_months(month_start(utc_now().date()), -MESSAGE_RETENTION_MONTHS)
+    async with async_session_maker() as session:
+        paths = await archive_partitions(session, before, args.dir)
+    logger.info("archived {} message partitions older than {}", len(paths), before)
+
+
+async def rebuild_unread_command(_: argparse.Namespace):
+    await init_redis_pool()
+    try:
+        deleted = await clear_unread(get_redis())
+        count = await reconcile_unread(get_redis())
+    finally:
+        await shutdown_redis_pool()
+    logger.info("unread counters rebuilt: {} users dropped, {} chats loaded", deleted, count)
+
+
+def month(value: str) -> date:
+    return date.fromisoformat(f"{value}-01")
+
+
+COMMANDS = {
+    'backfill-summary': backfill_summary_command,
+    'ensure-partitions': ensure_partitions_command,
+    'archive-partitions': archive_partitions_command,
+    'rebuild-unread': rebuild_unread_command,
+}
+
+
+async def run(args: argparse.Namespace):
+    try:
+        await COMMANDS[args.command](args)
+    finally:
+        await shutdown_engine()
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='python -m opti.manage')
+    commands = parser.add_subparsers(dest='command', required=True)
+    commands.add_parser('backfill-summary', help='rebuild conversation_summary from message table')
+    commands.add_parser('ensure-partitions', help='create message partitions for the next months')
+    archive = commands.add_parser('archive-partitions', help='move old message partitions to gzipped csv files')
+    archive.add_argument('--before', type=month, help='YYYY-MM, archive partitions of earlier months, '
+                                                      'default is MESSAGE_RETENTION_MONTHS ago')
+    archive.add_argument('--dir', default=MESSAGE_ARCHIVE_DIR, help='directory for the archives')
+    commands.add_parser('rebuild-unread', help='reload redis unread counters from conversation_summary')
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == '__main__':
+    main()
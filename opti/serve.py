@@ -0,0 +1,81 @@
+import math
+import sys
+
+from gunicorn.app.base import BaseApplication
+from gunicorn.arbiter import Arbiter
+from uvicorn import Server
+from uvicorn.workers import UvicornWorker
+
+from opti.chat.registry import chat_connections
+from opti.core.config import SERVE_HOST, SERVE_PORT, SERVE_WORKERS, SHUTDOWN_DRAIN_TIMEOUT, RECONNECT_JITTER
+
+
+# time left after the drain for http requests and the lifespan shutdown
+SHUTDOWN_GRACE = 10
+
+
+class DrainingServer(Server):
+    '''
+    Uvicorn closes websockets with 1012 right after it stops listening.
+    Chat clients are asked to reconnect first and get SHUTDOWN_DRAIN_TIMEOUT to go away.
+    '''
+
+    async def shutdown(self, sockets=None):
+        for server in self.servers:
+            server.close()
+        for sock in sockets or []:
+            sock.close()
+        if not self.force_exit:
+            await chat_connections.drain(SHUTDOWN_DRAIN_TIMEOUT, RECONNECT_JITTER)
+        await super().shutdown(sockets)
+
+
+class OptiWorker(UvicornWorker):
+    CONFIG_KWARGS = {
+        "loop": "uvloop",
+        "http": "httptools",
+        "lifespan": "on",
+        "timeout_graceful_shutdown": SHUTDOWN_GRACE,
+    }
+
+    async def _serve(self):
+        # same as UvicornWorker._serve with the draining server
+        self.config.app = self.wsgi
+        server = DrainingServer(config=self.config)
+        self._install_sigquit_handler()
+        await server.serve(sockets=self.sockets)
+        if not server.started:
+            sys.exit(Arbiter.WORKER_BOOT_ERROR)
+
+
+class OptiApplication(BaseApplication):
+    '''gunicorn master: binds the port and keeps SERVE_WORKERS workers running'''
+
+    def __init__(self, options: dict):
+        self.options = options
+        super().__init__()
+
+    def load_config(self):
+        for key, value in self.options.items():
+            self.cfg.set(key, value)
+
+    def load(self):
+        # imported by every worker after fork, pools are created in its own event loop
+        from opti.main import app
+        return app
+
+
+def main():
+    graceful_timeout = math.ceil(SHUTDOWN_DRAIN_TIMEOUT) + SHUTDOWN_GRACE
+    OptiApplication({
+        "bind": f"{SERVE_HOST}:{SERVE_PORT}",
+        "workers": SERVE_WORKERS,
+        "worker_class": OptiWorker,
+        "graceful_timeout": graceful_timeout,
+        "timeout": max(30, graceful_timeout),
+        "keepalive": 5,
+    }).run()
+
+
+if __name__ == "__main__":
+    main()
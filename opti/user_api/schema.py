@@ -19,3 +19,4 @@ class UserInfo(BaseModel):
 
 class SearchResult(BaseModel):
     users: list[UserInfo]
+    next_cursor: str | None = None
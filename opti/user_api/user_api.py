@@ -1,12 +1,19 @@
-from fastapi import APIRouter, Depends, Body
+import base64
+import json
+from uuid import UUID
+
+from fastapi import APIRouter, Depends, Body, HTTPException, Query
 from sqlalchemy import update, text
 from sqlalchemy.exc import SQLAlchemyError
+from starlette import status
 
 from opti.user_api.schema import CurrentUser, ChangeNickname, SearchResult, UserInfo
-from opti.auth.service import get_current_user_id, CREDENTIALS_EXCEPTION
+from opti.auth.service import get_current_user_id, block_user, CREDENTIALS_EXCEPTION
 from opti.core.database import get_async_session, AsyncSession
 from opti.auth.models import User
-from opti.core.config import logger
+from opti.core.cache import TTLCache
+from opti.core.config import logger, SEARCH_MIN_LENGTH, SEARCH_MAX_LENGTH, SEARCH_PAGE_SIZE, SEARCH_PAGE_SIZE_MAX, \
+    SEARCH_CACHE_SIZE, SEARCH_CACHE_TTL
 
 
 user_api = APIRouter(
@@ -20,7 +27,7 @@ async def get_current_user(
     user_id: str = Depends(get_current_user_id),
     session: AsyncSession = Depends(get_async_session)
 ) -> CurrentUser:
-    logger.debug(f'get me for {user_id}')
+    logger.debug('get me for {}', user_id)
     user = await session.get(User, user_id)
     return CurrentUser(id=user_id, email=user.email, nickname=user.nickname)
 
@@ -42,16 +49,106 @@ async def change_nickname(
         raise CREDENTIALS_EXCEPTION
 
 
+FUZZY_SEARCH_QUERY = """
+    SELECT users.id, users.nickname, similarity(users.nickname, :search_term) AS score FROM users
+    WHERE users.nickname % :search_term AND NOT users.is_blocked {after}
+    ORDER BY score DESC, users.id DESC
+    LIMIT :limit
+"""
+FUZZY_SEARCH_AFTER = "AND (similarity(users.nickname, :search_term), users.id) < (:cursor_score, :cursor_id)"
+PREFIX_SEARCH_QUERY = """
+    SELECT users.id, users.nickname FROM users
+    WHERE users.nickname ILIKE :pattern AND NOT users.is_blocked {after}
+    ORDER BY users.nickname, users.id
+    LIMIT :limit
+"""
+PREFIX_SEARCH_AFTER = "AND (users.nickname, users.id) > (:cursor_nickname, :cursor_id)"
+
+search_cache = TTLCache("user_api.search_cache", SEARCH_CACHE_SIZE, SEARCH_CACHE_TTL)
+
+
+def encode_cursor(data: dict) -> str:
+    return base64.urlsafe_b64encode(json.dumps(data).encode()).decode()
+
+
+def decode_cursor(cursor: str) -> dict:
+    try:
+        return json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except ValueError:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail='Invalid cursor')
+
+
+async def fuzzy_search(session: AsyncSession, search_term: str, limit: int, cursor: str | None) -> SearchResult:
+    params = {'search_term': search_term, 'limit': limit + 1}
+    after = ''
+    if cursor is not None:
+        cursor_data = decode_cursor(cursor)
+        try:
+            params.update(cursor_score=float(cursor_data['score']), cursor_id=UUID(cursor_data['id']))
+        except (KeyError, TypeError, ValueError):
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail='Invalid cursor')
+        after = FUZZY_SEARCH_AFTER
+    rows = (await session.execute(text(FUZZY_SEARCH_QUERY.format(after=after)), params)).all()
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor({'score': rows[-1].score, 'id': str(rows[-1].id)})
+    return SearchResult(users=[UserInfo(id=i.id, nickname=i.nickname) for i in rows], next_cursor=next_cursor)
+
+
+async def prefix_search(session: AsyncSession, search_term: str, limit: int, cursor: str | None) -> SearchResult:
+    escaped = search_term.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+    params = {'pattern': f'{escaped}%', 'limit': limit + 1}
+    after = ''
+    if cursor is not None:
+        cursor_data = decode_cursor(cursor)
+        try:
+            params.update(cursor_nickname=str(cursor_data['nickname']), cursor_id=UUID(cursor_data['id']))
+        except (KeyError, TypeError, ValueError):
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail='Invalid cursor')
+        after = PREFIX_SEARCH_AFTER
+    rows = (await session.execute(text(PREFIX_SEARCH_QUERY.format(after=after)), params)).all()
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor({'nickname': rows[-1].nickname, 'id': str(rows[-1].id)})
+    return SearchResult(users=[UserInfo(id=i.id, nickname=i.nickname) for i in rows], next_cursor=next_cursor)
+
+
 @user_api.get('/search', response_model=SearchResult)
 async def search_user(
-    q: str,
+    q: str = Query(min_length=SEARCH_MIN_LENGTH, max_length=SEARCH_MAX_LENGTH),
+    limit: int = Query(default=SEARCH_PAGE_SIZE, ge=1, le=SEARCH_PAGE_SIZE_MAX),
+    cursor: str | None = None,
+    prefix: bool = False,
+    _: UUID = Depends(get_current_user_id),
     session: AsyncSession = Depends(get_async_session)
 ):
-    logger.info(f'search user: {q}')
-    query = text("""
-            SELECT users.id, users.nickname FROM users
-            WHERE nickname % :search_term
-        """)
-    result = await session.execute(query, {'search_term': q})
-    users = SearchResult(users=[UserInfo(id=i.id, nickname=i.nickname) for i in result])
+    search_term = ' '.join(q.split()).lower()
+    if len(search_term) < SEARCH_MIN_LENGTH:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail='Search query is too short')
+
+    key = (prefix, search_term, limit, cursor)
+    if (users := search_cache.get(key)) is not None:
+        return users
+    search = prefix_search if prefix else fuzzy_search
+    users = await search(session, search_term, limit, cursor)
+    search_cache.set(key, users)
     return users
+
+
+@user_api.post('/{user_id}/block')
+async def block(
+    user_id: UUID,
+    current_user_id: UUID = Depends(get_current_user_id),
+    session: AsyncSession = Depends(get_async_session)
+):
+    current_user = await session.get(User, current_user_id)
+    if not current_user.is_superuser:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail='Only for superuser')
+    if await session.get(User, user_id) is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail='User not found')
+    await block_user(session, user_id)
+    logger.info('user {} blocked by {}', user_id, current_user_id)
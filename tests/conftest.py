@@ -9,7 +9,8 @@ from opti.core import config
 config.DB_NAME = 'test_opti'
 config.REDIS_DB = 2
 
-from opti.core.database import DBase, engine
+from opti.core.database import DBase, engine, async_session_maker
+from opti.chat.partitions import ensure_partitions
 from opti.core.redis import init_redis_pool, shutdown_redis_pool
 from opti.main import app
 
@@ -20,6 +21,8 @@ async def prepare_database():
     async with engine.begin() as conn:
         await conn.execute(text("CREATE EXTENSION IF NOT EXISTS \"uuid-ossp\""))
         await conn.run_sync(metadata.create_all)
+    async with async_session_maker() as session:
+        await ensure_partitions(session)
     yield
     async with engine.begin() as conn:
         await conn.run_sync(metadata.drop_all)
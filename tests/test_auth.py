@@ -1,9 +1,22 @@
+import json
+from uuid import uuid4
+
+import pytest
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+from fastapi import HTTPException
+from jose import jwk, jwt as jose_jwt
 from sqlalchemy import select
 
-from opti.auth.jwt import create_token
-from opti.auth.service import valid_user_from_db, get_current_user_id
+import opti.auth.jwt
+from opti.auth.api import get_id_from_email
+from opti.auth.jwt import create_token, decode_google_token, GoogleKeyStore
+from opti.auth.service import valid_user_from_db, get_current_user_id, user_id_from_token, token_cache, \
+    valid_user_cache, on_user_invalidated, email_cache, block_user, email_key
 from opti.auth.models import User
+from opti.core.config import GOOGLE_CLIENT_ID
 from opti.core.database import async_session_maker
+from opti.core.redis import get_redis
 from opti.core.utils import create_nickname_from_email
 
 
@@ -27,4 +40,70 @@ async def test_get_current_user_id():
         result = await session.execute(query)
         user = result.scalar()
         token = create_token(str(user.id))
-        assert user.id == await get_current_user_id(token)
\ No newline at end of file
+        assert user.id == await get_current_user_id(token)
+
+
+def test_token_cache():
+    user_id = uuid4()
+    token = create_token(str(user_id))
+    hits = token_cache.hits.value
+    assert user_id_from_token(token) == user_id
+    assert user_id_from_token(token) == user_id
+    assert token_cache.hits.value == hits + 1
+
+
+async def test_user_invalidation_clears_cache():
+    async with async_session_maker() as session:
+        query = select(User).where(User.email == email)
+        user = (await session.execute(query)).scalar()
+    assert await valid_user_from_db(user.id)
+    assert valid_user_cache.get(user.id)
+    on_user_invalidated(json.dumps({"user_id": str(user.id)}))
+    assert valid_user_cache.get(user.id) is None
+
+
+async def test_decode_google_token_with_local_jwks(tmp_path, monkeypatch):
+    private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    private_pem = private_key.private_bytes(
+        serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption(),
+    )
+    public_jwk = jwk.construct(private_pem, 'RS256').public_key().to_dict()
+    jwks_file = tmp_path / "jwks.json"
+    jwks_file.write_text(json.dumps({"keys": [{**public_jwk, "kid": "test"}]}))
+
+    store = GoogleKeyStore("http://unused", str(jwks_file))
+    await store.start()
+    monkeypatch.setattr(opti.auth.jwt, "google_key_store", store)
+    token = jose_jwt.encode(
+        {"email": email, "aud": GOOGLE_CLIENT_ID, "iss": "https://accounts.google.com"},
+        private_pem, algorithm='RS256', headers={"kid": "test"},
+    )
+    assert (await decode_google_token(token))["email"] == email
+
+
+async def test_get_id_from_email_upsert():
+    new_email = "upsert_user@gmail.com"
+    user_id = await get_id_from_email(new_email)
+    email_cache.clear()
+    await get_redis().delete(email_key(new_email))
+    assert await get_id_from_email(new_email) == user_id
+
+
+async def test_blocked_user_is_not_valid():
+    user_id = await get_id_from_email("blocked_valid@gmail.com")
+    assert await valid_user_from_db(user_id)
+    async with async_session_maker() as session:
+        await block_user(session, user_id)
+    assert not await valid_user_from_db(user_id)
+
+
+async def test_blocked_cached_email_cannot_login():
+    blocked_email = "blocked_login@gmail.com"
+    user_id = await get_id_from_email(blocked_email)
+    assert await get_id_from_email(blocked_email) == user_id
+    async with async_session_maker() as session:
+        await block_user(session, user_id)
+    with pytest.raises(HTTPException) as e:
+        await get_id_from_email(blocked_email)
+    assert e.value.status_code == 403
+    assert not await valid_user_from_db(user_id)
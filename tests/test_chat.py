@@ -1,8 +1,41 @@
+import asyncio
+import json
+from datetime import date, timedelta
+from uuid import uuid4
+
+import pytest
+from fastapi import WebSocketDisconnect
+from redis.asyncio import ConnectionPool
 from sqlalchemy import select
 
 from opti.auth.jwt import create_token
 from opti.auth.models import User
-from opti.core.database import async_session_maker
+from opti.auth.api import get_id_from_email
+from opti.chat.api import chat_input_handler
+from opti.chat.batcher import MessageBatcher
+from opti.chat.connection import ChatConnection, OverflowPolicy
+from opti.chat.dispatcher import ActionDispatcher
+from opti.chat.models import Message, ConversationSummary
+from opti.chat.partitions import add_months, partition_name, partition_month
+from opti.chat.presence import Presence, online_users
+from opti.chat.preview import get_cached_preview, preview_generation, store_preview, invalidate_preview
+from opti.chat.registry import ConnectionRegistry, CLOSE_SERVICE_RESTART
+from opti.chat.recent import get_recent, recent_generation, fill_recent, push_recent, mark_recent_viewed
+from opti.chat.purge import purge_cleared_chats_
+from opti.chat.service import delete_chat, get_chat, fetch_preview
+from opti.chat.summary import summary_on_send, summary_on_read
+import opti.chat.tasks
+from opti.chat.tasks import ensure_read_receipt_group, sync_read_message_
+from opti.chat.schema import MessageInChat, GetChatSchema, SendMessageSchema, ServerActionType, ClientReadMessagesSchema, \
+    DeleteChatScheme
+from opti.chat.serialization import dump
+from opti.core.config import CHAT_RECENT_DAYS, READ_RECEIPT_STREAM, READ_RECEIPT_GROUP
+from opti.core.utils import utc_now, to_naive_utc
+from opti.chat.unread import get_unread, increment_unread, decrement_unread
+from opti.chat.utils import chat_pair, WebsocketError
+from opti.core.database import async_session_maker, get_pool_stats
+from opti.core.pubsub import PubSubMultiplexer, ShardedPubSub, ShardMovedError
+from opti.core.redis import get_redis
 from tests.conftest import client
 from tests.test_auth import email
 
@@ -15,4 +48,380 @@ async def test_ws():
         token = create_token(str(user.id))
         with client.websocket_connect("/ws", cookies={"jwt": token}) as websocket:
             data = websocket.receive_json()
-            assert data == {"msg": "Hello WebSocket"}
\ No newline at end of file
+            assert data == {"msg": "Hello WebSocket"}
+
+def test_chat_pair_is_symmetric():
+    first, second = uuid4(), uuid4()
+    assert chat_pair(first, second) == chat_pair(second, first)
+    assert chat_pair(first, second)[0] == min(first, second)
+
+
+async def test_message_batcher_groups_rows():
+    written = []
+
+    class Batcher(MessageBatcher):
+        async def write(self, messages):
+            written.append(len(messages))
+
+    batcher = Batcher(max_rows=3, max_delay=0.01)
+    batcher.start()
+    messages = [Message(id=uuid4(), sender_id=uuid4(), recipient_id=uuid4(), message="hi") for _ in range(4)]
+    await asyncio.gather(*(batcher.submit(message) for message in messages))
+    await batcher.close()
+    assert written == [3, 1]
+
+
+async def test_dispatcher_validates_and_routes():
+    calls, timings = [], []
+
+    async def handler(websocket, db_session, user_id, data):
+        calls.append(data)
+
+    dispatcher = ActionDispatcher()
+    dispatcher.register(GetChatSchema, handler)
+    dispatcher.register(SendMessageSchema, handler)
+    dispatcher.add_timing_hook(lambda action_type, elapsed: timings.append(action_type))
+
+    recipient_id = uuid4()
+    raw = f'{{"action_type": "send_message", "recipient_id": "{recipient_id}", "message": "hi"}}'
+    await dispatcher.dispatch(None, None, uuid4(), raw)
+    assert isinstance(calls[0], SendMessageSchema) and calls[0].recipient_id == recipient_id
+    assert timings == [ServerActionType.send_message]
+
+    with pytest.raises(WebsocketError):
+        await dispatcher.dispatch(None, None, uuid4(), '{"action_type": "delete_chat", "user_id": "x"}')
+
+
+async def test_connection_coalesces_read_receipts():
+    class SlowWebsocket:
+        def __init__(self):
+            self.sent, self.ready = [], asyncio.Event()
+
+        async def send_text(self, payload):
+            await self.ready.wait()
+            self.sent.append(payload)
+
+    websocket = SlowWebsocket()
+    connection = ChatConnection(websocket, uuid4(), maxsize=1, policy=OverflowPolicy.coalesce)
+    connection.start()
+    read_ids = [uuid4() for _ in range(3)]
+    for message_id in read_ids:
+        connection.send(dump(ClientReadMessagesSchema(list_messages_id=[message_id])))
+    websocket.ready.set()
+    await asyncio.sleep(0.01)
+    await connection.close()
+
+    received = [json.loads(i)["list_messages_id"] for i in websocket.sent]
+    assert received == [[str(read_ids[0])], [str(i) for i in read_ids[1:]]]
+
+
+async def test_presence_counts_connections():
+    redis = get_redis()
+    presence = Presence(redis, interval=30)
+    user_id = uuid4()
+    await presence.connect(user_id)
+    await presence.connect(user_id)
+    await presence.disconnect(user_id)
+    assert await online_users(redis, [user_id]) == {user_id}
+    await presence.disconnect(user_id)
+    assert await online_users(redis, [user_id]) == set()
+
+
+async def test_pubsub_multiplexer_shards_and_fans_out():
+    redis = get_redis()
+    multiplexer = PubSubMultiplexer(redis, 4)
+    first, second, other = [], [], []
+    channels = [f"multiplexer_{i}" for i in range(8)]
+    try:
+        await multiplexer.subscribe(channels[0], first.append)
+        await multiplexer.subscribe(channels[0], second.append)
+        for channel in channels[1:]:
+            await multiplexer.subscribe(channel, other.append)
+        # every channel is subscribed on exactly one of the shared connections
+        for channel in channels:
+            assert sum(channel in i.sinks for i in multiplexer.connections) == 1
+        assert sum(bool(i.sinks) for i in multiplexer.connections) > 1
+        assert multiplexer.stats() == {"channels": 8, "subscribers": 9}
+
+        await redis.publish(channels[0], "hello")
+        await redis.publish(channels[5], "other")
+        for _ in range(50):
+            if first and second and other:
+                break
+            await asyncio.sleep(0.05)
+        assert first == second == ["hello"] and other == ["other"]
+
+        await multiplexer.unsubscribe(channels[0], first.append)
+        assert multiplexer.stats() == {"channels": 8, "subscribers": 8}
+    finally:
+        await multiplexer.close()
+
+
+async def test_sharded_pubsub_messages():
+    pubsub = ShardedPubSub(ConnectionPool(decode_responses=True))
+    message = await pubsub.handle_message(["smessage", "channel", "data"], ignore_subscribe_messages=True)
+    assert message["channel"] == "channel" and message["data"] == "data"
+    with pytest.raises(ShardMovedError):
+        await pubsub.handle_message(["sunsubscribe", "channel", 0], ignore_subscribe_messages=True)
+
+
+async def test_delete_chat_hides_then_purges():
+    class Connection:
+        def __init__(self):
+            self.sent = []
+
+        def send_model(self, model):
+            self.sent.append(model)
+
+    first = await get_id_from_email("purge_first@gmail.com")
+    second = await get_id_from_email("purge_second@gmail.com")
+    connection = Connection()
+    async with async_session_maker() as session:
+        messages = [Message(id=uuid4(), sender_id=first, recipient_id=second, message="hi") for _ in range(3)]
+        session.add_all(messages)
+        await summary_on_send(session, messages)
+        await session.commit()
+
+        await delete_chat(connection, session, first, DeleteChatScheme(user_id=second))
+        await get_chat(connection, session, first, GetChatSchema(user_id=second))
+        assert connection.sent[-1].messages == []
+
+        await purge_cleared_chats_()
+        left = await session.execute(select(Message).where(Message.sender_id == first))
+        assert left.scalars().all() == []
+
+
+async def test_summary_upsert_and_read():
+    first = await get_id_from_email("summary_first@gmail.com")
+    second = await get_id_from_email("summary_second@gmail.com")
+    now = to_naive_utc(utc_now())
+    messages = [
+        Message(id=uuid4(), sender_id=first, recipient_id=second, message="one", created_at=now - timedelta(seconds=2)),
+        Message(id=uuid4(), sender_id=first, recipient_id=second, message="two", created_at=now - timedelta(seconds=1)),
+        Message(id=uuid4(), sender_id=second, recipient_id=first, message="three", created_at=now),
+    ]
+    async with async_session_maker() as session:
+        session.add_all(messages[:2])
+        await summary_on_send(session, messages[:2])
+        await session.commit()
+        # the second batch updates the existing row
+        session.add(messages[2])
+        await summary_on_send(session, messages[2:])
+        await session.commit()
+
+    async with async_session_maker() as session:
+        [chat] = (await fetch_preview(session, second)).chat_list
+        assert chat.user.id == first and chat.count_unread_message == 2
+        assert chat.last_message.text == "three" and chat.last_message.recipient_id == first
+        [chat] = (await fetch_preview(session, first)).chat_list
+        assert chat.user.id == second and chat.count_unread_message == 1 and not chat.last_message.is_viewed
+
+        await summary_on_read(session, [(i.id, i.sender_id, i.recipient_id) for i in messages])
+        await session.commit()
+
+    async with async_session_maker() as session:
+        [chat] = (await fetch_preview(session, second)).chat_list
+        assert chat.count_unread_message == 0
+        [chat] = (await fetch_preview(session, first)).chat_list
+        assert chat.count_unread_message == 0 and chat.last_message.is_viewed
+
+
+async def test_sync_read_message_claims_and_acks(monkeypatch):
+    first = await get_id_from_email("receipt_first@gmail.com")
+    second = await get_id_from_email("receipt_second@gmail.com")
+    messages = [Message(id=uuid4(), sender_id=first, recipient_id=second, message="hi") for _ in range(2)]
+    async with async_session_maker() as session:
+        session.add_all(messages)
+        await summary_on_send(session, messages)
+        await session.commit()
+
+    redis = get_redis()
+    await ensure_read_receipt_group(redis)
+    # delivered to a consumer which died before acking it
+    await redis.xadd(READ_RECEIPT_STREAM, {"recipient_id": str(second), "ids": str(messages[0].id)})
+    await redis.xreadgroup(READ_RECEIPT_GROUP, "dead-consumer", {READ_RECEIPT_STREAM: ">"})
+    await redis.xadd(READ_RECEIPT_STREAM, {"recipient_id": str(second), "ids": f"{messages[1].id};"})
+    await redis.xadd(READ_RECEIPT_STREAM, {"recipient_id": "not an id", "ids": str(messages[1].id)})
+    monkeypatch.setattr(opti.chat.tasks, "READ_RECEIPT_CLAIM_IDLE_MS", 0)
+
+    await sync_read_message_()
+    assert (await redis.xpending(READ_RECEIPT_STREAM, READ_RECEIPT_GROUP))["pending"] == 0
+    assert await redis.xlen(READ_RECEIPT_STREAM) == 0
+    async with async_session_maker() as session:
+        result = await session.execute(select(Message.is_viewed).where(Message.id.in_([i.id for i in messages])))
+        assert result.scalars().all() == [True, True]
+
+
+async def test_get_chat_pages_match_cache_and_db():
+    class Connection:
+        def __init__(self):
+            self.sent = []
+
+        def send_model(self, model):
+            self.sent.append(model)
+
+    first = await get_id_from_email("page_first@gmail.com")
+    second = await get_id_from_email("page_second@gmail.com")
+    connection = Connection()
+    now = to_naive_utc(utc_now())
+    # pairs of messages share created_at, the oldest ones are past the recent window
+    times = [now - timedelta(days=CHAT_RECENT_DAYS + 2 - i // 2 * 2, seconds=1) for i in range(12)]
+    messages = [
+        Message(id=uuid4(), sender_id=first, recipient_id=second, message=str(i), created_at=time)
+        for i, time in enumerate(times)
+    ]
+    expected = [i.id for i in sorted(messages, key=lambda i: (i.created_at, i.id), reverse=True)]
+
+    async def page(before=None):
+        await get_chat(connection, session, first, GetChatSchema(user_id=second, limit=5, before=before))
+        result = connection.sent[-1]
+        return [i.id for i in result.messages[::-1]], result.next_cursor
+
+    async with async_session_maker() as session:
+        session.add_all(messages)
+        await summary_on_send(session, messages)
+        await session.commit()
+
+        # the first call reads the db and fills the recent list, the second one is served from it
+        from_db, db_cursor = await page()
+        assert await get_recent(get_redis(), first, second, 100) is not None
+        from_cache, cache_cursor = await page()
+        assert from_cache == from_db == expected[:5]
+        assert cache_cursor == db_cursor
+
+        ids, cursor = list(from_cache), cache_cursor
+        while cursor is not None:
+            next_ids, cursor = await page(cursor)
+            ids += next_ids
+        assert ids == expected
+
+
+async def test_delete_chat_without_summary_row():
+    class Connection:
+        def send_model(self, model):
+            pass
+
+    first = await get_id_from_email("clear_first@gmail.com")
+    second = await get_id_from_email("clear_second@gmail.com")
+    async with async_session_maker() as session:
+        with pytest.raises(WebsocketError):
+            await delete_chat(Connection(), session, first, DeleteChatScheme(user_id=second))
+        await session.rollback()
+
+        # messages written before the summary existed, backfill-summary has not run
+        session.add(Message(id=uuid4(), sender_id=first, recipient_id=second, message="hi"))
+        await session.commit()
+        await delete_chat(Connection(), session, first, DeleteChatScheme(user_id=second))
+        low_id, high_id = chat_pair(first, second)
+        summary = await session.get(ConversationSummary, (low_id, high_id))
+        assert summary.cleared_at is not None and summary.purge_pending
+
+
+def test_partition_months():
+    assert add_months(date(2024, 11, 1), 2) == date(2025, 1, 1)
+    assert add_months(date(2024, 1, 1), -1) == date(2023, 12, 1)
+    assert partition_name(date(2024, 3, 1)) == "message_p202403"
+    assert partition_month("message_p202403") == date(2024, 3, 1)
+    assert partition_month("message_default") is None
+
+
+async def test_unread_counters():
+    redis = get_redis()
+    user_id, peer_id, other_peer_id = uuid4(), uuid4(), uuid4()
+    await increment_unread(redis, user_id, peer_id)
+    await increment_unread(redis, user_id, peer_id)
+    assert await get_unread(redis, user_id, {peer_id: 0, other_peer_id: 4}) == {peer_id: 2, other_peer_id: 4}
+    await decrement_unread(redis, user_id, other_peer_id, 10)
+    assert await get_unread(redis, user_id, {other_peer_id: 4}) == {other_peer_id: 0}
+
+
+async def test_recent_messages_list():
+    redis = get_redis()
+    first, second = uuid4(), uuid4()
+    messages = [
+        MessageInChat(id=uuid4(), sender_id=first, recipient_id=second, text="hi", time=utc_now(), is_viewed=False)
+        for _ in range(3)
+    ]
+    await push_recent(redis, first, second, dump(messages[0]))
+    assert await get_recent(redis, first, second, 10) is None
+
+    generation = await recent_generation(redis, first, second)
+    await fill_recent(redis, second, first, generation, [dump(message) for message in messages[1::-1]])
+    await push_recent(redis, first, second, dump(messages[2]))
+    await mark_recent_viewed(redis, second, first, [messages[1].id])
+    # the sender reading its own message changes nothing
+    await mark_recent_viewed(redis, first, second, [messages[0].id])
+    cached = [MessageInChat.model_validate_json(entry) for entry in await get_recent(redis, first, second, 10)]
+    assert [message.id for message in cached] == [messages[2].id, messages[1].id, messages[0].id]
+    assert [message.is_viewed for message in cached] == [False, True, False]
+
+    # entries are decoded by the script, their field order and spacing do not matter
+    reordered = MessageInChat(id=uuid4(), sender_id=first, recipient_id=second, text="hi", time=utc_now(),
+                              is_viewed=False)
+    await push_recent(redis, first, second, json.dumps(dict(reversed(json.loads(dump(reordered)).items())), indent=1))
+    await mark_recent_viewed(redis, second, first, [reordered.id])
+    newest = MessageInChat.model_validate_json((await get_recent(redis, first, second, 1))[0])
+    assert newest == reordered.model_copy(update={"is_viewed": True})
+
+
+async def test_preview_cache_generation():
+    redis = get_redis()
+    user_id = uuid4()
+    generation = await preview_generation(redis, user_id)
+    await invalidate_preview(redis, [user_id])
+    await store_preview(redis, user_id, generation, "stale")
+    assert await get_cached_preview(redis, user_id) is None
+
+    await store_preview(redis, user_id, await preview_generation(redis, user_id), "fresh")
+    assert await get_cached_preview(redis, user_id) == "fresh"
+
+
+async def test_registry_drains_connections():
+    class Websocket:
+        def __init__(self):
+            self.sent, self.close_code = [], None
+
+        async def send_text(self, payload):
+            self.sent.append(json.loads(payload))
+
+        async def close(self, code):
+            self.close_code = code
+
+    registry = ConnectionRegistry()
+    leaving, staying = ChatConnection(Websocket(), uuid4()), ChatConnection(Websocket(), uuid4())
+    for connection in (leaving, staying):
+        connection.start()
+        registry.add(connection)
+    asyncio.get_running_loop().call_later(0.05, registry.discard, leaving)
+
+    assert await registry.drain(timeout=0.3, jitter=1) == 1
+    for connection in (leaving, staying):
+        [frame] = connection.websocket.sent
+        assert frame["action_type"] == "reconnect" and 0 <= frame["retry_after"] <= 0.3
+    assert leaving.websocket.close_code is None
+    assert staying.websocket.close_code == CLOSE_SERVICE_RESTART
+    await leaving.close()
+
+
+async def test_chat_input_handler_releases_db_connections():
+    async with async_session_maker() as session:
+        user = (await session.execute(select(User).where(User.email == email))).scalar()
+    frames = [dump(GetChatSchema(user_id=user.id))]
+
+    class Websocket:
+        async def receive_text(self):
+            # the socket is still open here, no connection may stay checked out between actions
+            assert get_pool_stats()["checked_out"] == 0
+            if frames:
+                return frames.pop()
+            raise WebSocketDisconnect()
+
+        async def send_text(self, payload):
+            pass
+
+    connection = ChatConnection(Websocket(), user.id)
+    connection.start()
+    with pytest.raises(WebSocketDisconnect):
+        await chat_input_handler(connection, user.id)
+    await connection.close()
+    assert get_pool_stats()["checked_out"] == 0
@@ -0,0 +1,64 @@
+import asyncio
+
+from httpx import AsyncClient
+
+from opti.core.cache import SingleFlight
+from opti.core.config import logger, HTTP_POOL_SIZE, HTTP_POOL_SIZE_PER_HOST, HTTP_TIMEOUT
+from opti.core.http import init_http_client, get_http_client, shutdown_http_client
+from opti.core.log import parse_levels, ThrottledLogger
+
+
+async def test_health(ac: AsyncClient):
+    response = await ac.get("/api/health")
+    assert response.status_code == 200
+    pool = response.json()["db_pool"]
+    assert pool["checked_out"] == 0
+    assert pool["size"] > 0
+
+
+def test_log_levels_and_throttle():
+    assert parse_levels("opti.chat=warning, opti.auth=DEBUG,") == {"opti.chat": "WARNING", "opti.auth": "DEBUG"}
+
+    records = []
+    sink = logger.add(lambda message: records.append(message.record), level="DEBUG")
+    try:
+        throttled = ThrottledLogger(interval=60)
+        for i in range(5):
+            throttled.warning("websocket error: {}", i)
+        throttled.last["websocket error: {}"] -= 60
+        throttled.warning("websocket error: {}", 5)
+    finally:
+        logger.remove(sink)
+    assert [r["message"] for r in records] == ["websocket error: 0", "websocket error: 5"]
+    assert [r["extra"]["suppressed"] for r in records] == [0, 4]
+
+
+async def test_single_flight_survives_cancelled_leader():
+    flight, calls = SingleFlight(), []
+
+    async def load():
+        calls.append(1)
+        await asyncio.sleep(0.05)
+        return len(calls)
+
+    leader = asyncio.create_task(flight.do("key", load))
+    await asyncio.sleep(0)
+    followers = [asyncio.create_task(flight.do("key", load)) for _ in range(2)]
+    await asyncio.sleep(0.01)
+    leader.cancel()
+    # one follower takes over the call, the other one shares its result
+    assert await asyncio.gather(*followers) == [2, 2]
+    assert leader.cancelled()
+
+
+async def test_http_client_is_shared():
+    await init_http_client()
+    session = get_http_client()
+    try:
+        assert get_http_client() is session
+        assert session.connector.limit == HTTP_POOL_SIZE
+        assert session.connector.limit_per_host == HTTP_POOL_SIZE_PER_HOST
+        assert session.timeout.total == HTTP_TIMEOUT
+    finally:
+        await shutdown_http_client()
+    assert session.closed
@@ -34,3 +34,31 @@ async def test_change_nickname(ac: AsyncClient):
         })
         assert response.status_code == 200
         assert new_nickname == response.json()['new_nickname']
+
+
+async def test_search_user_prefix(ac: AsyncClient):
+    async with async_session_maker() as session:
+        for i in range(3):
+            session.add(User(email=f"search_{i}@gmail.com", nickname=f"searchable_{i}"))
+        await session.commit()
+        user = (await session.execute(select(User).where(User.email == email))).scalar()
+    cookies = {"jwt": create_token(str(user.id))}
+
+    response = await ac.get("/api/user/search", params={"q": "Searchable", "prefix": True, "limit": 2}, cookies=cookies)
+    assert response.status_code == 200
+    data = response.json()
+    assert [i["nickname"] for i in data["users"]] == ["searchable_0", "searchable_1"]
+
+    response = await ac.get("/api/user/search", params={
+        "q": "Searchable", "prefix": True, "limit": 2, "cursor": data["next_cursor"],
+    }, cookies=cookies)
+    data = response.json()
+    assert [i["nickname"] for i in data["users"]] == ["searchable_2"]
+    assert data["next_cursor"] is None
+
+
+async def test_search_user_too_short(ac: AsyncClient):
+    async with async_session_maker() as session:
+        user = (await session.execute(select(User).where(User.email == email))).scalar()
+    response = await ac.get("/api/user/search", params={"q": "s"}, cookies={"jwt": create_token(str(user.id))})
+    assert response.status_code == 422